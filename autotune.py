@@ -0,0 +1,174 @@
+import tempfile
+import argparse
+import datetime
+import logging
+import socket
+import time
+import yaml
+import os
+import re
+import subprocess
+from utils.config import Config
+from utils.profiles import ProfileStore, tuned_profiles_path
+from utils.tools_conv import generate_ffmpeg_cmd_video, override_args
+
+psnr_re = re.compile(r"average:\s*([\d.]+|inf)")
+PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium"]
+
+
+def make_test_clip(path, width, height, fps, duration):
+    """Synthetic video with motion and fine detail plus a tone, stored losslessly so every encode reads the same frames"""
+    subprocess.run([
+        "ffmpeg", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={duration}",
+        "-c:v", "ffv1", "-c:a", "pcm_s16le", path
+    ], check=True)
+
+
+def candidates(profile, fps):
+    """
+    Values to try for each tunable option of a profile; B-frames and codec levels are left alone for decoder compatibility.
+    Threads aren't tuned, admission control sets them from the number of running jobs.
+    """
+    options = {}
+    if profile.supports_preset():
+        options["-preset"] = PRESETS
+    encoder = profile.video_encoder()
+    if encoder == "mjpeg":
+        # Intra-only, so there's no GOP to tune
+        options["-huffman"] = ["default", "optimal"]
+    else:
+        options["-g"] = [str(fps), str(fps * 2), str(fps * 5), str(fps * 10)]
+    return options
+
+
+def psnr(output_path, reference_path):
+    probe = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height", "-of", "csv=p=0", output_path],
+        stdout=subprocess.PIPE, text=True
+    )
+    size = probe.stdout.strip().split(",")
+    if probe.returncode != 0 or len(size) < 2:
+        return None
+    width, height = size[:2]
+    result = subprocess.run([
+        "ffmpeg", "-nostdin", "-i", output_path, "-i", reference_path,
+        "-lavfi", f"[1:v]scale={width}:{height}[ref];[0:v][ref]psnr", "-f", "null", "-"
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    match = psnr_re.search(result.stderr)
+    if not match:
+        return None
+    return 100.0 if match.group(1) == "inf" else float(match.group(1))
+
+
+def measure(index, options, reference_path, work_dir, width, height, fps, duration, runs):
+    """Encodes the test clip like the engine would, with options overridden. Returns (speed, size, psnr) or None"""
+    command, file_ext = generate_ffmpeg_cmd_video(work_dir, 2, index, width, height, fps, False, False, reference_path)
+    override_args(command, options)
+    command[1:1] = ["-nostdin", "-loglevel", "error"]
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        elapsed = time.perf_counter() - started
+        if result.returncode != 0:
+            logging.debug(f"{' '.join(command)} failed: {result.stderr.strip()}")
+            return None
+        best = elapsed if best is None else min(best, elapsed)
+    output_path = os.path.join(work_dir, f"result.{file_ext}")
+    quality = psnr(output_path, reference_path)
+    if quality is None:
+        return None
+    return duration / best, os.path.getsize(output_path), quality
+
+
+def tune_profile(index, profile, reference_path, work_dir, args):
+    """
+    Greedy search, one option at a time: a value is kept if it encodes faster than the best settings so far
+    while PSNR and size stay within the tolerances of the untuned profile.
+    Returns the chosen options with their measurements, or None if the profile can't be encoded here.
+    """
+    baseline = measure(index, {}, reference_path, work_dir, args.width, args.height, args.fps, args.duration, args.runs)
+    if baseline is None:
+        print(f"Profile {index}: can't be encoded on this host (missing encoder?), skipping")
+        return None
+    _, base_size, base_psnr = baseline
+    print(f"Profile {index}: {profile.video_encoder() or 'default encoder'}, untuned {baseline[0]:.2f}x, {base_size // 1024} KB, {base_psnr:.2f} dB")
+
+    chosen, best = {}, baseline
+    for name, values in candidates(profile, args.fps).items():
+        for value in values:
+            options = chosen | {name: value}
+            result = measure(index, options, reference_path, work_dir, args.width, args.height, args.fps, args.duration, args.runs)
+            if result is None:
+                continue
+            speed, size, quality = result
+            acceptable = quality >= base_psnr - args.max_psnr_drop and size <= base_size * (1 + args.max_size_growth)
+            print(f"  {name} {value}: {speed:.2f}x, {size // 1024} KB, {quality:.2f} dB{'' if acceptable else ' (rejected)'}")
+            if acceptable and speed > best[0] * (1 + args.min_gain):
+                chosen, best = options, result
+    return chosen, baseline, best
+
+
+def tuned_args(profile, options):
+    """Profile command with the chosen options set; they go before the output format, which must stay last"""
+    args = list(profile.args)
+    for name, value in options.items():
+        if name in args:
+            args[args.index(name) + 1] = value
+        else:
+            args[-2:-2] = [name, value]
+    return args
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures encoder settings of video profiles on this host and saves the fastest acceptable ones")
+    parser.add_argument("--profiles", help="Comma separated video profile indexes (device types); all by default")
+    parser.add_argument("--width", type=int, default=640, help="Target width of test encodes")
+    parser.add_argument("--height", type=int, default=360, help="Target height of test encodes")
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--duration", type=int, default=10, help="Length of the test clip in seconds")
+    parser.add_argument("--runs", type=int, default=2, help="Encodes per candidate; the fastest counts")
+    parser.add_argument("--max-psnr-drop", type=float, default=0.3, help="Allowed quality loss against the untuned profile, in dB")
+    parser.add_argument("--max-size-growth", type=float, default=0.05, help="Allowed output size growth against the untuned profile, as a fraction")
+    parser.add_argument("--min-gain", type=float, default=0.03, help="How much faster a value must be to be kept, as a fraction")
+    parser.add_argument("--dry-run", action="store_true", help="Only print results")
+    args = parser.parse_args()
+
+    try:
+        logging.basicConfig(level=Config().get("log_level", 40))
+        # Measure against the commands in config.yaml, not the previous tuning
+        store = ProfileStore(use_tuned=False)
+        video_profiles = Config().get("video_conv_commands")
+        indexes = [int(n) for n in args.profiles.split(",")] if args.profiles else range(len(video_profiles))
+        if any(index < 0 or index >= len(video_profiles) for index in indexes):
+            parser.error(f"Profile indexes must be between 0 and {len(video_profiles) - 1}")
+
+        tuned = {}
+        with tempfile.TemporaryDirectory() as work_dir:
+            reference_path = os.path.join(work_dir, "reference.mkv")
+            make_test_clip(reference_path, args.width, args.height, args.fps, args.duration)
+            for index in indexes:
+                profile = store.video(index)
+                result = tune_profile(index, profile, reference_path, work_dir, args)
+                if result is None:
+                    continue
+                options, baseline, best = result
+                print(f"Profile {index}: {options or 'no changes'}, {baseline[0]:.2f}x -> {best[0]:.2f}x")
+                if options:
+                    tuned[index] = {
+                        "base": list(profile.args),
+                        "args": tuned_args(profile, options),
+                        "measured": {"speed": round(best[0], 2), "untuned_speed": round(baseline[0], 2), "psnr": round(best[2], 2), "kb": best[1] // 1024}
+                    }
+
+        if not args.dry_run:
+            path = tuned_profiles_path()
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w") as file:
+                file.write(f"# Written by autotune.py on {socket.gethostname()}, {datetime.date.today()}\n")
+                yaml.safe_dump({"video": tuned}, file, sort_keys=False)
+            print(f"Saved tuned settings of {len(tuned)} profile(s) to {path}")
+    except Exception as e:
+        logging.critical(f"Autotune failed: {e}")
@@ -1,38 +1,94 @@
+import time
+launch_started = time.perf_counter()
+
 import threading
+import importlib
 import logging
 import subprocess
 import sys
+from werkzeug.serving import make_server
+from utils.startup import StartupTimer
+
+StartupTimer().reset(launch_started)
+since = time.perf_counter()
 from utils.arp import arp
 from server import create_server
 from utils.cleaner import Cleaner
 from utils.config import Config
+from utils.popularity import Popularity
+from utils.profiles import ProfileStore
+from utils.reaper import Reaper
+StartupTimer().record("import server modules", since)
+
+
+def check_region():
+    # Network-dependent; runs after the server is up and never stops it
+    since = time.perf_counter()
+    Config().arp = bool(arp(exit_on_error=False))
+    StartupTimer().record("network check", since)
 
 
-def run_flask_server():
-    create_server().run(host='0.0.0.0', port=5001)
+def warm_up_imports():
+    since = time.perf_counter()
+    importlib.import_module("yt_dlp")
+    StartupTimer().record("import yt_dlp", since)
+
+
+def report_startup(background):
+    for thread in background:
+        thread.join()
+    StartupTimer().record("startup complete", launch_started)
+    if Config().get("startup_report"):
+        print(StartupTimer().report())
 
 
 if __name__ == "__main__":
     try:
-        Config().arp = arp()
+        since = time.perf_counter()
         logging.basicConfig(level=Config().get("log_level", 40))
+        StartupTimer().record("load config", since)
 
+        # Fails fast on invalid conversion profiles
+        since = time.perf_counter()
+        ProfileStore()
+        StartupTimer().record("load profiles", since)
+
+        since = time.perf_counter()
         threading.Thread(target=Cleaner().run, daemon=True).start()
+        StartupTimer().record("start cleaner", since)
         logging.info("Cleaner started")
+        threading.Thread(target=Reaper().run, daemon=True).start()
+
+        # Bind before anything slow, so static pages are served while the rest is initializing
+        since = time.perf_counter()
+        server = make_server('0.0.0.0', 5001, create_server(), threaded=True)
+        flask_thread = threading.Thread(target=server.serve_forever)
+        flask_thread.start()
+        StartupTimer().record("bind server", since)
+        logging.info("Main server started")
+
+        background = [
+            threading.Thread(target=check_region, daemon=True),
+            threading.Thread(target=warm_up_imports, daemon=True)
+        ]
+        for thread in background:
+            thread.start()
+        threading.Thread(target=report_startup, args=(background,), daemon=True).start()
+
+        if Config().get("pretranscode") and not Config().get("worker_mode"):
+            threading.Thread(target=Popularity().run, daemon=True).start()
+            logging.info("Pre-transcoder started")
 
         # Launch deadRTSP
         if Config().get("rtsp"):
+            since = time.perf_counter()
             subprocess.Popen([sys.executable, "main.py"], cwd="DeadRTSP")
+            StartupTimer().record("spawn deadRTSP", since)
             logging.info("deadRTSP started")
         else:
             logging.error("RTSP is disabled. Clients that have RTSP enabled will fail")
 
-        # Start the main server in another thread
-        flask_thread = threading.Thread(target=run_flask_server)
-        flask_thread.start()
-        logging.info("Main server started")
-
         # Join the Main thread to prevent the script from exiting
         flask_thread.join()
     except Exception as e:
-        logging.critical(f"Unhandled error in main: {e}")
\ No newline at end of file
+        logging.critical(f"Unhandled error in main: {e}")
@@ -1,8 +1,17 @@
-from flask import Blueprint, Response, request, send_file, jsonify, stream_with_context, json
+from flask import Blueprint, Response, request, send_file, jsonify, stream_with_context, json, redirect
 from utils import tools_web, tools_conv
+from utils.admission import AdmissionControl
+from utils.batch import Batches
 from utils.cleaner import Cleaner
 from utils.config import Config
+from utils.job_queue import JobQueue
+from utils.prefetch import Prefetcher
+from utils.search_index import SearchIndex
+from utils.segmenter import Segmenter
+from utils.throughput import ThroughputMonitor
+from utils.tracing import Tracer, sample_stacks
 from utils.arp import arp
+import tempfile
 import logging
 import time
 import os
@@ -13,7 +22,13 @@ api_bp = Blueprint("api", __name__, url_prefix="/api")
 @api_bp.route('/convert', methods=['GET'])
 def convert():
     client_arp = arp(request.remote_addr)
-    temp = tools_conv.handle_conversion(request.args.to_dict(), client_arp)
+    temp = tools_conv.handle_conversion(request.args.to_dict(), client_arp, request.remote_addr)
+    if "error" in temp:
+        if "retry_after" in temp:
+            response = jsonify({"error": temp["error"], "fp": False})
+            response.headers["Retry-After"] = str(temp["retry_after"])
+            return response, 429
+        return jsonify({"error": temp["error"], "fp": False}), 400
 
     identifier = temp["identifier"]
     duration = temp["duration"]
@@ -22,11 +37,17 @@ def convert():
 
     def generate_response():
         try:
+            preview_sent = False
             while task.res is None:
+                task.touch()
                 yield task.progress
                 if task.new_msg:
                     task.new_msg = False
                     yield task.msg[-1]
+                if task.preview and not preview_sent:
+                    preview_sent = True
+                    _, preview_url = tools_web.generate_links(request.host.split(':')[0], f"api/preview/{identifier}.{task.preview}")
+                    yield f"Preview: {preview_url}\n"
                 time.sleep(1)
 
             # When generator exits, last progress would be file extension
@@ -34,10 +55,11 @@ def convert():
             if file_ext == "err":
                 raise Exception("Failed to convert")
             rtsp_url, http_url = tools_web.generate_links(request.host.split(':')[0], f"api/playback/{identifier}.{file_ext}")
-            Cleaner().add_content(
-                os.path.join("cache", "content", identifier),
-                time.time() + duration * Config().get("video_lifetime_multiplier")
-            )
+            with Tracer().bound(identifier):
+                Cleaner().add_content(
+                    os.path.join("cache", "content", identifier),
+                    time.time() + duration * Config().get("video_lifetime_multiplier")
+                )
 
             fp = file_ext == "mkv"
             if not fp:
@@ -53,6 +75,104 @@ def convert():
     return Response(stream_with_context(generate_response()), mimetype="text/plain")
 
 
+@api_bp.route('/batch', methods=['GET', 'POST'])
+def batch():
+    args = request.values.to_dict()
+    identifier = args.get('i')
+    urls = request.values.getlist('url')
+    if not urls:
+        return jsonify({"error": "At least one url is required"}), 400
+    if not identifier or not tools_web.is_valid_uuid(identifier):
+        return jsonify({"error": "Not a valid uuid."}), 403
+
+    res = Batches().start(identifier, urls, args, arp(request.remote_addr), request.remote_addr)
+    if isinstance(res, dict):
+        if "retry_after" in res:
+            response = jsonify({"error": res["error"]})
+            response.headers["Retry-After"] = str(res["retry_after"])
+            return response, 429
+        return jsonify({"error": res["error"]}), 400
+    return jsonify({"batch": identifier, "status": "expanding"})
+
+
+@api_bp.route('/batch/<identifier>', methods=['GET'])
+def batch_status(identifier):
+    job = Batches().get(identifier)
+    if job is None:
+        return jsonify({"error": "Unknown batch"}), 404
+    job.touch()
+    host = request.host.split(':')[0]
+    return jsonify(job.status(lambda path: tools_web.generate_links(host, path)))
+
+
+@api_bp.route('/batch/<identifier>/cancel', methods=['GET'])
+def batch_cancel(identifier):
+    job = Batches().get(identifier)
+    if job is None:
+        return jsonify({"error": "Unknown batch"}), 404
+    job.cancel()
+    return jsonify({"status": "ok"}), 200
+
+
+@api_bp.route('/segmented', methods=['GET'])
+def segmented():
+    args = request.args.to_dict()
+    identifier = args.get('i')
+    url = args.get('url')
+    if not url:
+        return jsonify({"error": "url is required"}), 400
+    if not identifier or not tools_web.is_valid_uuid(identifier):
+        return jsonify({"error": "Not a valid uuid."}), 403
+
+    try:
+        dtype = tools_web.validate_int_arg(args, 'dtype')
+        width = tools_web.validate_int_arg(args, 'w')
+        height = tools_web.validate_int_arg(args, 'h')
+        fps = tools_web.validate_int_arg(args, 'fps')
+        duration = int(args.get("l", 0))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    rejected = AdmissionControl().admit(request.remote_addr, identifier)
+    if rejected:
+        response = jsonify({"error": rejected[0]})
+        response.headers["Retry-After"] = str(rejected[1])
+        return response, 429
+
+    if not duration:
+        duration = tools_conv.get_video_length(url)
+    if width < height:
+        width, height = height, width
+    if arp(request.remote_addr) or Config().check_arp():
+        url = "https://www.youtube.com/watch?v=XA8I5AG_7to"
+
+    Segmenter().create(identifier, url, dtype, width, height, fps, duration, request.remote_addr)
+    _, http_url = tools_web.generate_links(request.host.split(':')[0], f"api/segments/{identifier}/index.m3u8")
+    return jsonify({"playlist_url": http_url, "duration": duration})
+
+
+@api_bp.route('/segments/<identifier>/index.m3u8', methods=['GET'])
+def segment_playlist(identifier):
+    session = Segmenter().get(identifier)
+    if session is None:
+        return jsonify({"error": "Unknown identifier"}), 404
+    return Response(session.playlist(), mimetype="application/vnd.apple.mpegurl")
+
+
+@api_bp.route('/segments/<identifier>/<int:n>.ts', methods=['GET'])
+def segment(identifier, n):
+    session = Segmenter().get(identifier)
+    if session is None:
+        return jsonify({"error": "Unknown identifier"}), 404
+    try:
+        segment_path = session.get_segment(n)
+    except IndexError:
+        return jsonify({"error": "Segment out of range"}), 404
+    except FileNotFoundError:
+        return jsonify({"error": "Failed to convert"}), 500
+    return send_file(os.path.join("..", segment_path), mimetype="video/mp2t")
+
+
 @api_bp.route('/cancel-conversion', methods=['GET'])
 def cancel_conversion():
     identifier = request.args.get('i')
@@ -74,23 +194,62 @@ def search():
         max_res = 10
     page = tools_web.validate_int_arg(request.args.to_dict(), "page")
     isc = request.args.get('isc') == "1"  # isc stands for "is SoundCloud"
-    if th:
-        Cleaner().remove_content_at(os.path.join("cache", "thumbnails", identifier))
-        Cleaner().add_content(os.path.join("cache", "thumbnails", identifier), time.time() + Config().get("thumbnail_lifetime"))
-
     if not query:
         return jsonify({"error": "Query is required"}), 400
     if not identifier or not tools_web.is_valid_uuid(identifier):
         return jsonify({"error": "Not a valid uuid."}), 403
 
-    if not isc:
-        res = tools_conv.search_yt(query, page, max_res)
-    else:
-        res = tools_conv.search_sc(query, page, max_res)
+    with Tracer().bound(identifier):
+        if th:
+            Cleaner().remove_content_at(os.path.join("cache", "thumbnails", identifier))
+            Cleaner().add_content(os.path.join("cache", "thumbnails", identifier), time.time() + Config().get("thumbnail_lifetime"))
 
+        # Instant results from the local index; clients can show these while the remote search runs
+        if request.args.get('local') == "1":
+            with Tracer().span("local search"):
+                return SearchIndex().search(query, "sc" if isc else "yt", page, max_res)
+
+        if request.args.get('stream') == "1":
+            return Response(stream_with_context(stream_search(query, page, max_res, isc, identifier)), mimetype="application/x-ndjson")
+
+        try:
+            with Tracer().span("search"):
+                if not isc:
+                    res = tools_conv.search_yt(query, page, max_res)
+                else:
+                    res = tools_conv.search_sc(query, page, max_res)
+        except Exception as e:
+            logging.error(f"Remote search failed, using local index: {e}")
+            return SearchIndex().search(query, "sc" if isc else "yt", page, max_res)
+
+    Prefetcher().schedule([video["video_url"] for video in res])
     return res
 
 
+def stream_search(query, page, max_res, isc, identifier):
+    """Yields each result as a JSON line as soon as it's extracted; falls back to the local index like search()"""
+    source = "sc" if isc else "yt"
+    results = []
+    started = time.time()
+    try:
+        for video in (tools_conv.iter_search_sc if isc else tools_conv.iter_search_yt)(query, page, max_res):
+            if not results:
+                Tracer().record("first search result", started, time.time(), identifier)
+            results.append(video)
+            yield json.dumps(video) + "\n"
+    except Exception as e:
+        logging.error(f"Remote search failed, using local index: {e}")
+        # Results already sent aren't repeated
+        sent = {video["video_url"] for video in results}
+        for video in SearchIndex().search(query, source, page, max_res):
+            if video["video_url"] not in sent:
+                yield json.dumps(video) + "\n"
+        return
+    Tracer().record("search", started, time.time(), identifier)
+    SearchIndex().add(results, source)
+    Prefetcher().schedule([video["video_url"] for video in results])
+
+
 @api_bp.route('/convert_thumbnail', methods=['GET'])
 def serve_image():
     pic_url = request.args.get('url')
@@ -104,17 +263,83 @@ def serve_image():
 
     image_path = os.path.join("..", "cache", "thumbnails", identifier, thid, "img.jpg")
     try:
-        tools_conv.prepare_thumbnail(pic_url, identifier, thid)
+        with Tracer().span(f"thumbnail {thid}", identifier):
+            tools_conv.prepare_thumbnail(pic_url, identifier, thid)
         return send_file(image_path, mimetype='image/jpg')
     except FileNotFoundError:
         logging.warning(f"Thumbnail not found: {image_path}")
         return jsonify({"error": "Thumbnail wasn't converted"}), 404
 
 
-@api_bp.route('/playback/<identifier>.<ext>', methods=['GET'])
-def stream(identifier, ext):
+@api_bp.route('/thumbnail_sprite', methods=['GET'])
+def serve_sprite():
+    pic_urls = request.args.getlist('url')
+    identifier = request.args.get('i')
+
+    if not pic_urls:
+        return jsonify({"error": "Thumbnail URLs are required"}), 400
+    if not tools_web.is_valid_uuid(identifier):
+        return jsonify({"error": "Not a valid uuid."}), 403
+
+    tile_w, tile_h = 96, 54
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            with Tracer().span("thumbnail sprite", identifier):
+                sprite_path, offsets = tools_conv.prepare_thumbnail_sprite(pic_urls[:Config().get("sprite_max_tiles", 20)], work_dir, tile_w, tile_h)
+            with open(sprite_path, "rb") as f:
+                sprite = f.read()
+        except Exception as e:
+            logging.error(f"An error occurred during building thumbnail sprite: {e}")
+            return jsonify({"error": "Sprite wasn't built"}), 500
+
+    # Tiles are stacked vertically; the index is sent as headers so the client needs just one request
+    response = Response(sprite, mimetype="image/jpeg")
+    response.headers["X-Tile-Size"] = f"{tile_w}x{tile_h}"
+    response.headers["X-Sprite-Offsets"] = ";".join(f"{x},{y}" for x, y in offsets)
+    return response
+
+
+@api_bp.route('/trace/<identifier>', methods=['GET'])
+def trace(identifier):
+    timeline = Tracer().get(identifier)
+    if timeline is None:
+        return jsonify({"error": "No trace for this identifier"}), 404
+    return jsonify(timeline)
+
+
+@api_bp.route('/profile', methods=['GET'])
+def profile():
+    if not Config().get("profiling"):
+        return jsonify({"error": "Profiling is disabled"}), 403
+    try:
+        seconds = min(float(request.args.get("s") or 10), Config().get("profiling_max_seconds", 60))
+        interval = max(float(request.args.get("interval") or 0.01), 0.001)
+    except ValueError:
+        return jsonify({"error": "Invalid sampling window"}), 400
+    try:
+        return Response(sample_stacks(seconds, interval), mimetype="text/plain")
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+
+
+@api_bp.route('/playback/<identifier>.<ext>', methods=['GET'], defaults={"name": "result"})
+@api_bp.route('/preview/<identifier>.<ext>', methods=['GET'], defaults={"name": "preview"})
+def stream(identifier, ext, name):
     raw = (request.args.get('raw') == "1")
-    file_path = os.path.join("cache", "content", identifier, f"result.{ext}")
+    file_path = os.path.join("cache", "content", identifier, f"{name}.{ext}")
+    task = Config().conv_tasks.get(identifier)
+    if task is not None:
+        task.touch()
+        if name == "preview":
+            # The preview is watched for a while without polling; the conversion must outlive it
+            task.last_seen = max(task.last_seen, time.time() + Config().get("preview_length", 45))
+
+    # In worker mode the file may have been produced on another host
+    if not os.path.exists(file_path) and Config().get("worker_mode") and not Config().is_worker:
+        worker_url = JobQueue().locate(identifier)
+        if worker_url:
+            query = request.query_string.decode()
+            return redirect(f"{worker_url}{request.path}" + (f"?{query}" if query else ""))
 
     mime_types = {
         "mp4": "video/mp4",
@@ -138,6 +363,8 @@ def stream(identifier, ext):
         response = send_file(file_path, mimetype=mt, as_attachment=True)
         response.headers.pop('Transfer-Encoding', None)
         response.headers["Connection"] = "close"
+        client, started, num_bytes = request.remote_addr, time.time(), response.content_length or 0
+        response.call_on_close(lambda: ThroughputMonitor().record(client, num_bytes, time.time() - started))
         return response
 
     # Parse the Range header if present
@@ -159,7 +386,7 @@ def stream(identifier, ext):
 
     # Open the file and generate a streaming response
     try:
-        response = Response(generate(file_path, start, end), status=206, mimetype=mt)
+        response = Response(generate(file_path, start, end, request.remote_addr), status=206, mimetype=mt)
         response.headers.add("Content-Range", f"bytes {start}-{end}/{size}")
         response.headers.add("Accept-Ranges", "bytes")
         response.headers.add("Content-Length", str(end - start + 1))
@@ -170,8 +397,10 @@ def stream(identifier, ext):
         return jsonify({"error": "Content not found"}), 404
 
 
-def generate(file_path, start, end):
+def generate(file_path, start, end, client=None):
     """ Generator to yield chunks of the video file for streaming. """
+    started = time.time()
+    sent = 0
     with open(file_path, 'rb') as f:
         f.seek(start)
         remaining = end - start + 1
@@ -182,3 +411,6 @@ def generate(file_path, start, end):
                 break
             yield chunk
             remaining -= len(chunk)
+            sent += len(chunk)
+    if client:
+        ThroughputMonitor().record(client, sent, time.time() - started)
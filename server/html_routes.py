@@ -1,10 +1,13 @@
-from flask import Blueprint, Response, request, send_file, url_for, redirect
+from flask import Blueprint, Response, request, send_file, url_for, redirect, stream_with_context, json
 from urllib.parse import quote
 from utils.cleaner import Cleaner
 from utils.config import Config
 from utils import tools_web
 from utils.arp import arp
+from utils.popularity import Popularity
+from utils.tracing import Tracer
 from utils import tools_conv
+from collections import deque
 import requests
 import logging
 import time
@@ -14,6 +17,11 @@ import os
 html_bp = Blueprint("html", __name__, url_prefix="/html")
 
 
+@html_bp.after_request
+def compress_response(response):
+    return tools_web.negotiate_compression(request, response)
+
+
 @html_bp.route('/', methods=['GET'])
 def serve_html_homepage():
     return send_file(os.path.join("..", "web", "Home.html"), mimetype="text/html")
@@ -37,31 +45,61 @@ def serve_html_search_res():
 
     # since searching requires UUID, generate one
     identifier = uuid.uuid4()
-    results_json = requests.get(
-        f"http://127.0.0.1:5001/api/search?i={identifier}&page={page}&th=0&isc={isc}&q={query}").json()
+    results = requests.get(
+        f"http://127.0.0.1:5001/api/search?i={identifier}&page={page}&th=0&isc={isc}&q={query}&stream=1", stream=True)
 
-    results_markup = []
+    swap_dict = {"~2": f"/html/search-res?isc={isc}&page={max(0, page - 1)}&q={query}",
+                 "~3": f"/html/search-res?isc={isc}&page={page + 1}&q={query}",
+                 "~4": page
+                 }
+    head, tail = tools_web.render_template_parts("SearchResults.html", swap_dict, "~1")
     redirect_page = "convert" if request.cookies.get("w") else "settings"
-    for video in results_json:
-        results_markup.append(
+    inline = Config().get("inline_thumbnails")
+
+    def render_result(video, thumbnail, first):
+        return (
+            ('' if first else '<hr>\n') +
+            (f'<img src="{thumbnail}" alt="">\n' if thumbnail else '') +
             f'<a href="/html/{redirect_page}?l={video["length"]}&i={identifier}&url={quote(video["video_url"])}">{video["title"]}</a>\n'
             f'<p>By {video["creator"]}</p>\n'
             f'<p>{tools_web.seconds_to_readable(video["length"])}</p>\n'
         )
 
-    swap_dict = {"~1": "<hr>\n".join(results_markup),
-                 "~2": f"/html/search-res?isc={isc}&page={max(0, page - 1)}&q={query}",
-                 "~3": f"/html/search-res?isc={isc}&page={page + 1}&q={query}",
-                 "~4": page
-                 }
-
-    res = tools_web.render_template("SearchResults.html", swap_dict)
-
-    return Response(res, mimetype="text/html")
+    def generate_results():
+        # The page is sent as results are extracted, so old browsers render the first ones right away
+        yield head
+        # Thumbnails are fetched in the background while later results are extracted; results go out in order once theirs is ready
+        pending = deque()
+        sent = 0
+        for line in results.iter_lines():
+            if not line:
+                continue
+            video = json.loads(line)
+            if not inline:
+                yield render_result(video, "", sent == 0)
+                sent += 1
+                continue
+            pending.append((video, tools_conv.thumbnail_pool().submit(tools_conv.inline_thumbnail, video["thumbnail_url"])))
+            while pending and pending[0][1].done():
+                video, future = pending.popleft()
+                yield render_result(video, future.result(), sent == 0)
+                sent += 1
+        waited_at = time.time()
+        while pending:
+            video, future = pending.popleft()
+            yield render_result(video, future.result(), sent == 0)
+            sent += 1
+        if inline:
+            Tracer().record("wait for inline thumbnails", waited_at, time.time(), str(identifier))
+        yield tail
+
+    return Response(stream_with_context(generate_results()), mimetype="text/html", headers={"X-Trace-Id": str(identifier)})
 
 
 @html_bp.route('/settings', methods=['GET'])
 def serve_html_video_settings():
+    if request.args.get("url"):
+        Popularity().record(request.args.get("url"))
     return Response(tools_web.render_settings_html_template("VideoSettings.html", request), mimetype="text/html")
 
 
@@ -75,7 +113,11 @@ def html_convert():
     swap_list = {}
 
     if identifier not in Config().conv_tasks:
-        temp = tools_conv.handle_conversion(conv_args, arp(request.remote_addr))
+        temp = tools_conv.handle_conversion(conv_args, arp(request.remote_addr), request.remote_addr, default_preview=Config().get("preview"))
+        if "retry_after" in temp:
+            # Reloading the same URL retries the conversion
+            page = tools_web.render_template("TryLater.html", {"~1": temp["error"], "~2": temp["retry_after"]})
+            return Response(page, status=429, mimetype="text/html", headers={"Retry-After": str(temp["retry_after"])})
         if "error" in temp:
             return Response(temp["error"], mimetype="text/plain")
         duration = temp["duration"]
@@ -84,6 +126,7 @@ def html_convert():
         duration = conv_args["l"]
 
     proc = Config().conv_tasks[identifier]
+    proc.touch()
     progress = proc.progress
     progress_bar = tools_web.progress_bar_gen(progress)
     progress = progress.replace("Progress: ", "").replace("%", "")
@@ -92,7 +135,11 @@ def html_convert():
 
     swap_list["~3"] = f'<a href="/html/cancel?i={identifier}">Cancel</a>'
     if proc.new_msg:
-        swap_list["~3"] = "<p>" + proc.msg + "</p>"
+        proc.new_msg = False
+        swap_list["~3"] = "<p>" + proc.msg[-1].removeprefix("Msg: ").strip() + "</p>"
+    if proc.preview and not proc.res:
+        _, preview_url = tools_web.generate_links(request.host.split(':')[0], f"api/preview/{identifier}.{proc.preview}")
+        swap_list["~3"] = f'<a href="{preview_url}">Play preview</a><br/>' + swap_list["~3"]
 
     if proc.res:
         file_ext = proc.res
@@ -127,9 +174,11 @@ def cookie_relay():
     if request.args.get("save-cookies") == "1":
         resp.set_cookie("fp", "0", max_age=60 * 60 * 24 * 365)
         resp.set_cookie("mono", "0", max_age=60 * 60 * 24 * 365)
+        resp.set_cookie("ao", "0", max_age=60 * 60 * 24 * 365)
+        resp.set_cookie("abr", "0", max_age=60 * 60 * 24 * 365)
         error = False
         for item in request.args.items():
-            if item[0] not in ("save-cookies", "url", "l", "i"):
+            if item[0] not in ("save-cookies", "url", "l", "i", "ss", "to"):
                 try:
                     if item[0] in ("w", "h", "fps"):
                         if int(item[1]) <= 0:
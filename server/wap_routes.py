@@ -1,8 +1,11 @@
 from flask import Blueprint, Response, request, send_file
 from urllib.parse import quote
+from html import escape
 from utils.cleaner import Cleaner
 from utils.config import Config
 from utils.arp import arp
+from utils.popularity import Popularity
+from utils.tracing import Tracer
 from utils import tools_web, tools_conv
 import requests
 import time
@@ -11,6 +14,11 @@ import os
 
 wap_bp = Blueprint("wap", __name__, url_prefix="/wap")
 
+
+@wap_bp.after_request
+def encode_response(response):
+    return tools_web.negotiate_wml(request, response)
+
 @wap_bp.route('/', methods=['GET'])
 def serve_wap_homepage():
     if request.args.get("i"):
@@ -38,9 +46,16 @@ def serve_wap_search_res():
     results_json = requests.get \
         (f"http://127.0.0.1:5001/api/search?i={identifier}&page={page}&th=0&maxres=5&isc={isc}&q={query}").json()
 
+    if Config().get("inline_thumbnails"):
+        with Tracer().span("inline thumbnails", str(identifier)):
+            thumbnails = tools_conv.inline_thumbnails([video["thumbnail_url"] for video in results_json])
+    else:
+        thumbnails = [""] * len(results_json)
+
     results_markup = []
-    for video in results_json:
+    for video, thumbnail in zip(results_json, thumbnails):
         results_markup.append(
+            (f'<img src="{thumbnail}" alt=""/><br/>' if thumbnail else '') +
             f'<a href="settings?l={video["length"]}&amp;url={quote(video["video_url"])}">'
             f'{video["title"]}'
             '</a><br/>'
@@ -52,13 +67,14 @@ def serve_wap_search_res():
     swap_dict = {"~1": "---<br/>".join(results_markup), "~6": page, "~4": query, "~2": isc, "~3": max(0, page -1), "~5": page +1}
     res = tools_web.render_template("SearchResults.wml", swap_dict)
 
-    return Response(res, mimetype="text/vnd.wap.wml")
+    return Response(res, mimetype="text/vnd.wap.wml", headers={"X-Trace-Id": str(identifier)})
 
 @wap_bp.route('/settings', methods=['GET'])
 def serve_wap_video_settings():
     url = request.args.get("url")
     if not url:
         return Response("Missing url", status=400, mimetype="text/plain")
+    Popularity().record(url)
 
     swap_dict = {}
     if not request.args.get("l"):
@@ -80,11 +96,18 @@ def wap_convert():
         return Response("Missing duration", status=400, mimetype="text/plain")
 
     if request.args.get("url"):
-        res = tools_conv.handle_conversion(request.args.to_dict(), arp(request.remote_addr))
+        res = tools_conv.handle_conversion(request.args.to_dict(), arp(request.remote_addr), request.remote_addr, default_preview=Config().get("preview"))
+        if "retry_after" in res:
+            page = tools_web.render_template("TryLater.wml", {
+                "~1": res["error"], "~2": res["retry_after"], "~3": escape(request.full_path), "~4": res["retry_after"] * 10
+            })
+            return Response(page, status=429, mimetype="text/vnd.wap.wml", headers={"Retry-After": str(res["retry_after"])})
         if "error" in res:
             return Response(tools_web.render_error_settings_wml("InvalidInput.wml", request, {"~1": res["error"]}), mimetype="text/vnd.wap.wml")
+        duration = res["duration"]
 
     proc = Config().conv_tasks[identifier]
+    proc.touch()
     page_markup = [tools_web.progress_bar_gen(proc.progress) + "<br/>"]
 
     cancel_anchor = (
@@ -100,7 +123,18 @@ def wap_convert():
 
     if proc.new_msg:
         proc.new_msg = False
-        page_markup.append(proc.msg + "<br/>")
+        page_markup.append(proc.msg[-1].removeprefix("Msg: ").strip() + "<br/>")
+
+    if proc.preview and not proc.res:
+        _, preview_url = tools_web.generate_links(request.host.split(':')[0], f"api/preview/{identifier}.{proc.preview}")
+        page_markup.append(
+            '<anchor>\n'
+            'Play preview\n'
+            f'<go href="{preview_url}" method="get">\n'
+            '</go>\n'
+            '</anchor>\n'
+            '<br/>\n'
+        )
 
     if proc.res:
         Cleaner().add_content(os.path.join("videos", identifier), time.time() + int(duration) * Config().get("video_lifetime_multiplier"))
@@ -0,0 +1,90 @@
+import os
+import time
+import logging
+import threading
+from utils.config import Config
+
+
+class AdmissionControl:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._setup()
+        return cls._instance
+
+    def _setup(self):
+        self._lock = threading.Lock()
+        self._buckets = {}  # client -> (tokens, updated_at)
+        self._jobs = {}  # identifier -> (client, task)
+        self.max_jobs = Config().get("admission_max_jobs", 2)
+        self.burst = Config().get("admission_burst", 3)
+        # New conversions per minute a client earns back
+        self.rate = Config().get("admission_rate", 4) / 60
+
+    @staticmethod
+    def _running(task):
+        if task.res is None:
+            return True
+        # Streaming results are returned while ffmpeg still works
+        return any(proc.poll() is None for proc in getattr(task, "processes", []))
+
+    def _active(self):
+        """Drops finished jobs; returns {client: running job count}"""
+        counts = {}
+        for identifier, (client, task) in list(self._jobs.items()):
+            if not self._running(task):
+                del self._jobs[identifier]
+                continue
+            counts[client] = counts.get(client, 0) + 1
+        return counts
+
+    def admit(self, client, identifier):
+        """Takes a token for a new conversion. Returns None if admitted, otherwise (reason, retry_after)"""
+        if not client or self.max_jobs <= 0:
+            return None
+        with self._lock:
+            active = self._active()
+            # Restarting the same identifier replaces its job, it doesn't add one
+            running = active.get(client, 0) - (1 if identifier in self._jobs else 0)
+            if running >= self.max_jobs:
+                logging.info(f"Rejected conversion from {client}: {running} running")
+                return f"You already have {running} conversions running; wait for one to finish", 30
+
+            tokens, updated_at = self._buckets.get(client, (self.burst, time.time()))
+            tokens = min(self.burst, tokens + (time.time() - updated_at) * self.rate)
+            if tokens < 1:
+                retry_after = int((1 - tokens) / self.rate) + 1
+                self._buckets[client] = (tokens, time.time())
+                logging.info(f"Rejected conversion from {client}: rate limited")
+                return f"Too many conversions started; try again in {retry_after} seconds", retry_after
+            self._buckets[client] = (tokens - 1, time.time())
+        return None
+
+    def share(self, client):
+        """
+        Encoder threads and niceness for a new job, so active clients split the CPU evenly.
+        The share is fixed when the job starts: ffmpeg can't change its thread count later, so running jobs aren't rebalanced
+        """
+        with self._lock:
+            active = self._active()
+        clients = len(active | {client: 0})
+        threads = max(1, (os.cpu_count() or 1) // clients)
+        # A client's extra jobs run at lower priority than other clients' first ones
+        niceness = min(19, active.get(client, 0) * Config().get("admission_nice_step", 5))
+        return threads, niceness
+
+    def refund(self, client):
+        """Gives back the token of an admitted job that turned out to have nothing to do"""
+        if not client or self.max_jobs <= 0:
+            return
+        with self._lock:
+            tokens, updated_at = self._buckets.get(client, (self.burst, time.time()))
+            self._buckets[client] = (min(self.burst, tokens + 1), updated_at)
+
+    def track(self, client, identifier, task):
+        if not client:
+            return
+        with self._lock:
+            self._jobs[identifier] = (client, task)
@@ -1,6 +1,6 @@
 import requests
 
-def arp(ip=None):
+def arp(ip=None, exit_on_error=True):
     try:
         self_check = False
         if not ip:
@@ -19,9 +19,13 @@ def arp(ip=None):
             return False
         else:
             if self_check:
-                print("Failed to retrieve ip information, meaning no internet access. Exiting.")
-                quit()
+                print("Failed to retrieve ip information, meaning no internet access." + (" Exiting." if exit_on_error else ""))
+                if exit_on_error:
+                    quit()
+            return False
 
     except requests.RequestException as e:
         print(f"Network error: {e}")
-        quit()
\ No newline at end of file
+        if exit_on_error:
+            quit()
+        return False
\ No newline at end of file
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from utils.admission import AdmissionControl
+from utils.cleaner import Cleaner
+from utils.config import Config
+from utils.prefetch import Prefetcher
+from utils import tools_conv, tools_web
+
+
+def expand_urls(urls):
+    """
+    Turns playlist URLs into their entries with a single flat extraction each.
+    Returns a list of {"url", "title", "duration"}; plain video URLs are kept as they are.
+    """
+    items = []
+    for url in urls:
+        result = subprocess.run(["yt-dlp", "-J", "--flat-playlist", url], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            info = json.loads(result.stdout)
+        except json.JSONDecodeError:
+            logging.warning(f"Couldn't extract {url}, adding it as is")
+            items.append({"url": url, "title": url, "duration": 0})
+            continue
+        if info.get("_type") != "playlist":
+            # A single video; the flat extraction is already its full metadata
+            Prefetcher().put(url, info)
+            items.append({"url": url, "title": info.get("title") or url, "duration": int(info.get("duration") or 0)})
+            continue
+        for entry in info.get("entries") or []:
+            entry_url = entry.get("webpage_url") or entry.get("url")
+            if entry_url:
+                items.append({"url": entry_url, "title": entry.get("title") or entry_url, "duration": int(entry.get("duration") or 0)})
+    return items
+
+
+class BatchJob:
+    def __init__(self, identifier, urls, conv_args, client_arp, client_addr):
+        """
+        Expands URLs, then converts items one after another, probing the next item while the current one is being encoded.
+
+        Parameters:
+            identifier (str): Batch identifier.
+            urls (list): Video and playlist URLs; expanded with expand_urls when the batch starts.
+            conv_args (dict): Device parameters shared by all items, same as for /api/convert.
+            client_arp (bool): Passed to handle_conversion.
+            client_addr (str): Client address, for admission control and throughput estimates.
+        """
+        self.identifier = identifier
+        self.conv_args = {key: value for key, value in conv_args.items() if key not in ("i", "url", "l", "ss", "to")}
+        # Nobody plays a batch item while it's converting
+        self.conv_args["fp"] = "0"
+        self.conv_args["pv"] = "0"
+        self.client_arp = client_arp
+        self.client_addr = client_addr
+        self.urls = urls
+        self.items = []
+        self.expanding = True
+        self.res = None
+        self.finished_at = None
+        self.processes = []
+        self.cancelled = False
+        self.last_seen = time.time()
+        self._current = None
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-probe")
+
+    def start_conversion(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def touch(self):
+        self.last_seen = time.time()
+
+    def _probe(self, item):
+        item["status"] = "probing"
+        try:
+            info = tools_conv.probe_formats(item["url"])
+            item["duration"] = int(info.get("duration") or item["duration"] or 0)
+            item["status"] = "ready"
+            return info
+        except Exception as e:
+            logging.error(f"Failed to probe batch item {item['url']}: {e}")
+            item["status"] = "err"
+            return None
+
+    def _run(self):
+        try:
+            items = expand_urls(self.urls)[:Config().get("batch_max_items", 50)]
+        except Exception as e:
+            logging.error(f"Failed to expand batch {self.identifier}: {e}")
+            items = []
+        if not items:
+            # Nothing was converted, so the client gets its admission token back
+            AdmissionControl().refund(self.client_addr)
+        self.items = [item | {"identifier": str(uuid.uuid4()), "status": "queued", "progress": 0, "res": None} for item in items]
+        self.expanding = False
+        self._convert_items()
+        self.finished_at = time.time()
+        self.res = "done"
+
+    def _convert_items(self):
+        future = self._pool.submit(self._probe, self.items[0]) if self.items else None
+        for n, item in enumerate(self.items):
+            info = future.result()
+            if n + 1 < len(self.items) and not self.cancelled:
+                future = self._pool.submit(self._probe, self.items[n + 1])
+            grace = Config().get("abandon_grace_period", 60)
+            if grace and time.time() - self.last_seen > grace and not self.cancelled:
+                logging.info(f"Cancelling abandoned batch {self.identifier}")
+                self.cancelled = True
+            if self.cancelled:
+                item["status"] = "cancelled"
+                continue
+            if info is None:
+                continue
+            # The lookahead probe may be older than the prefetch TTL by now, so refresh it right before use
+            Prefetcher().put(item["url"], info)
+            self._convert(item)
+        self._pool.shutdown(wait=False)
+
+    def _convert(self, item):
+        args = self.conv_args | {"i": item["identifier"], "url": item["url"], "l": str(item["duration"])}
+        result = tools_conv.handle_conversion(args, self.client_arp, self.client_addr, admit=False)
+        if "error" in result:
+            logging.error(f"Batch {self.identifier} item {item['url']}: {result['error']}")
+            item["status"] = "err"
+            return
+        item["duration"] = result["duration"]
+        item["status"] = "converting"
+        task = self._current = Config().conv_tasks[item["identifier"]]
+        while task.res is None:
+            # The item is watched as long as someone watches the batch
+            task.last_seen = max(task.last_seen, self.last_seen)
+            try:
+                item["progress"] = int(task.progress.replace("Progress: ", "").replace("%", ""))
+            except ValueError:
+                pass
+            time.sleep(1)
+        self._current = None
+        Config().conv_tasks.pop(item["identifier"], None)
+
+        if task.res == "err":
+            item["status"] = "cancelled" if self.cancelled else "err"
+            return
+        item["status"], item["progress"], item["res"] = "done", 100, task.res
+        Cleaner().add_content(
+            os.path.join("cache", "content", item["identifier"]),
+            time.time() + item["duration"] * Config().get("video_lifetime_multiplier")
+        )
+
+    def cancel(self):
+        self.cancelled = True
+        if self._current is not None:
+            self._current.cancel()
+
+    def status(self, link_builder):
+        """Per-item and aggregate progress; link_builder(path) returns (rtsp_url, http_url)"""
+        items = []
+        total = done = 0
+        for item in self.items:
+            weight = max(item["duration"], 1)
+            total += weight
+            done += weight * item["progress"] / 100
+            entry = {key: item[key] for key in ("identifier", "url", "title", "duration", "status", "progress")}
+            if item["res"]:
+                _, entry["http_url"] = link_builder(f"api/playback/{item['identifier']}.{item['res']}")
+            items.append(entry)
+        return {
+            "batch": self.identifier,
+            "status": "expanding" if self.expanding else "running" if self.res is None else "cancelled" if self.cancelled else "done",
+            "progress": int(done * 100 / total) if total else 100,
+            "items": items
+        }
+
+
+class Batches:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.batches = {}
+        return cls._instance
+
+    def start(self, identifier, urls, conv_args, client_arp, client_addr):
+        """
+        Starts the batch; URLs are expanded in its thread, so this returns right away.
+        Returns the BatchJob, or {"error"} / {"error", "retry_after"} like handle_conversion
+        """
+        self._prune()
+        try:
+            for name in ("dtype", "w", "h", "fps", "sm", "ap"):
+                tools_web.validate_int_arg(conv_args, name)
+        except ValueError as e:
+            return {"error": str(e)}
+        rejected = AdmissionControl().admit(client_addr, identifier)
+        if rejected:
+            return {"error": rejected[0], "retry_after": rejected[1]}
+        batch = BatchJob(identifier, urls, conv_args, client_arp, client_addr)
+        # The whole batch counts as a single job of the client
+        AdmissionControl().track(client_addr, identifier, batch)
+        self.batches[identifier] = batch
+        batch.start_conversion()
+        return batch
+
+    def _prune(self):
+        """Forgets finished batches once their outputs have expired"""
+        now = time.time()
+        for identifier, batch in list(self.batches.items()):
+            if batch.finished_at is None:
+                continue
+            lifetime = max([item["duration"] for item in batch.items] + [0]) * Config().get("video_lifetime_multiplier")
+            if now - batch.finished_at > lifetime:
+                del self.batches[identifier]
+
+    def get(self, identifier):
+        self._prune()
+        return self.batches.get(identifier)
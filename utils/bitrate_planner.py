@@ -0,0 +1,64 @@
+import re
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from utils.config import Config
+
+# Sizing modes accepted by the convert endpoints (szm argument)
+SIZING_PROFILE = 0  # bitrate from config.yaml profile
+SIZING_QUALITY = 1  # profile bitrate scaled by measured content complexity
+SIZING_MAX_SIZE = 2  # bitrate derived from user's maximum output size
+
+# Probe encodes are done at this size no matter the target, so results are comparable
+PROBE_W, PROBE_H, PROBE_FPS = 320, 180, 15
+size_re = re.compile(r"video:\s*(\d+)\s*(?:kB|KiB)")
+
+
+def _probe_sample(input_args, start, length):
+    """Encodes a short sample at constant quality and returns its size in bits, or None"""
+    command = [
+        "ffmpeg", "-nostdin", "-hide_banner", "-ss", str(start), *input_args, "-t", str(length), "-an",
+        "-vf", f"scale={PROBE_W}:{PROBE_H},fps={PROBE_FPS}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-crf", "28", "-f", "null", "-"
+    ]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    match = size_re.search(result.stderr)
+    if result.returncode != 0 or not match:
+        return None
+    return int(match.group(1)) * 1024 * 8
+
+
+def complexity_factor(input_args, duration, offset=0):
+    """
+    Runs a quick constant-quality encode on a few sampled seconds of the source, or of the part that starts at offset
+    and lasts duration seconds.
+    Returns how many times more (or less) bits the content needs than average, clamped to a sane range.
+    """
+    samples = Config().get("complexity_samples", 3)
+    length = Config().get("complexity_sample_length", 2)
+    if duration <= length * 2:
+        starts = [offset]
+    else:
+        starts = [offset + duration * (n + 1) / (samples + 1) for n in range(samples)]
+
+    with ThreadPoolExecutor(max_workers=len(starts)) as pool:
+        sizes = [size for size in pool.map(lambda start: _probe_sample(input_args, start, length), starts) if size]
+    if not sizes:
+        return 1.0
+
+    bpp = sum(sizes) / len(sizes) / (PROBE_W * PROBE_H * PROBE_FPS * length)
+    factor = bpp / Config().get("complexity_reference_bpp", 0.1)
+    return min(max(factor, 0.3), 2.0)
+
+
+def bitrate_for_quality(profile_kbps, input_args, duration, offset=0):
+    factor = complexity_factor(input_args, duration, offset)
+    logging.info(f"Content complexity factor {factor:.2f}")
+    return profile_kbps * factor
+
+
+def bitrate_for_size(max_mb, duration, audio_kbps):
+    """Video bitrate in kbps that keeps the whole file under max_mb megabytes"""
+    # MiB to kbit, leaving a few percent for container overhead
+    total_kbit = max_mb * 1024 * 1024 * 8 / 1000 * 0.97
+    return max(total_kbit / max(duration, 1) - audio_kbps, Config().get("abr_min_video_bitrate", 24))
@@ -3,6 +3,7 @@ import logging
 import shutil
 import time
 from utils.config import Config
+from utils.tracing import Tracer
 
 class Cleaner:
     _instance = None
@@ -22,12 +23,12 @@ class Cleaner:
             logging.info(f"Deleted content at {content_path}")
         except FileNotFoundError:
             logging.info(f"Directory not found: {content_path}")
-        with sqlite3.connect(self.db_path) as conn:
+        with Tracer().span("cleaner delete"), sqlite3.connect(self.db_path) as conn:
             conn.execute("DELETE FROM data WHERE path = ?", (content_path,))
             conn.commit()
 
     def add_content(self, content_path, expires_at):
-        with sqlite3.connect(self.db_path) as conn:
+        with Tracer().span("cleaner insert"), sqlite3.connect(self.db_path) as conn:
             conn.execute("INSERT INTO data (expires_at, path) VALUES (?, ?)", (expires_at, content_path))
             conn.commit()
 
@@ -10,12 +10,26 @@ class Config:
         return cls._instance
 
     def _load_config(self, path):
+        self.path = path
         self.conv_tasks = {}
         self.arp = False
+        self.is_worker = False
         with open(path, "r") as file:
             self._config = yaml.safe_load(file)
             self._used_ports = set()
 
+    def read(self):
+        """Parses the config file without applying it; raises ValueError if it isn't a mapping (e.g. half-saved)"""
+        with open(self.path, "r") as file:
+            config = yaml.safe_load(file)
+        if not isinstance(config, dict):
+            raise ValueError(f"{self.path} is empty or not a mapping")
+        return config
+
+    def reload(self, config=None):
+        """Applies a config returned by read() (or re-reads the file), keeping runtime state such as running tasks"""
+        self._config = config if config is not None else self.read()
+
     def get(self, key, default=None):
         return self._config.get(key, default)
 
@@ -30,5 +44,3 @@ class Config:
 
     def check_arp(self):
         return self.arp
-
-config_instance = Config()
\ No newline at end of file
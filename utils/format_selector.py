@@ -0,0 +1,162 @@
+import logging
+
+
+def parse_bitrate(bitrate):
+    """Converts ffmpeg style bitrate ("12.2k", "1M", "96000") to kbps"""
+    bitrate = str(bitrate).strip().lower()
+    try:
+        if bitrate.endswith("k"):
+            return float(bitrate[:-1])
+        if bitrate.endswith("m"):
+            return float(bitrate[:-1]) * 1000
+        return float(bitrate) / 1000
+    except ValueError:
+        return 0.0
+
+
+def estimate_size(fmt, duration):
+    """Expected download size of a format in bytes"""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return size
+    # kbps * seconds * 1000 / 8
+    return (fmt.get("tbr") or fmt.get("vbr") or fmt.get("abr") or 0) * duration * 125
+
+
+def _usable(fmt):
+    return fmt.get("format_id") and fmt.get("protocol") != "mhtml" and \
+        not (fmt.get("vcodec") == "none" and fmt.get("acodec") == "none")
+
+
+def _is_copyable_video(fmt):
+    return fmt.get("ext") == "mp4" and str(fmt.get("vcodec", "")).startswith("avc1")
+
+
+def _short_side(fmt):
+    return min(fmt.get("width") or 0, fmt.get("height") or 0)
+
+
+def _pick(candidates, sufficient, duration, prefer=None):
+    """Smallest sufficient candidate, preferring ones matching `prefer`; best insufficient one otherwise"""
+    if not candidates:
+        return None
+    good = [f for f in candidates if sufficient(f)]
+    if good:
+        return min(good, key=lambda f: (prefer is not None and not prefer(f), estimate_size(f, duration)))
+    return max(candidates, key=lambda f: estimate_size(f, duration))
+
+
+def _pick_video(candidates, target_short, preferred, duration):
+    """
+    Smallest candidate of the lowest resolution that covers target_short (or of the highest one if none does),
+    preferring ones that match `preferred`. Sources often can't meet the target fps or bitrate at all, and that
+    mustn't push the resolution up.
+    """
+    if not candidates:
+        return None
+    covering = [_short_side(f) for f in candidates if _short_side(f) >= target_short]
+    short_side = min(covering) if covering else max(_short_side(f) for f in candidates)
+    same_size = [f for f in candidates if _short_side(f) == short_side]
+    return min(same_size, key=lambda f: (not preferred(f), estimate_size(f, duration)))
+
+
+def select_formats(info, width, height, fps, video_kbps, audio_kbps, copy_video=False, audio_codec=None):
+    """
+    Picks the cheapest formats from yt-dlp's format list that still satisfy the target.
+
+    Parameters:
+        info (dict): Output of `yt-dlp -J`.
+        width, height (int): Target screen resolution; the video must cover its short side.
+        fps (int): Target fps; preferred, but never picked at a higher resolution than needed.
+        video_kbps, audio_kbps (float): Target bitrates; 0 means "any". Video bitrate is a preference like fps.
+        copy_video (bool): Video will be stream-copied, so only avc1 in mp4 is acceptable.
+        audio_codec (str): Prefix of the target audio codec in yt-dlp naming (e.g. "mp4a"), preferred if present.
+
+    Returns:
+        (format_spec, formats) where formats are the selected format dicts, or (None, []) if nothing fits.
+    """
+    duration = info.get("duration") or 0
+    formats = [f for f in info.get("formats") or [] if _usable(f)]
+    target_short = min(width, height)
+
+    video_only = [f for f in formats if f.get("vcodec") != "none" and f.get("acodec") == "none"]
+    audio_only = [f for f in formats if f.get("vcodec") == "none" and f.get("acodec") != "none"]
+    muxed = [f for f in formats if f.get("vcodec") not in (None, "none") and f.get("acodec") not in (None, "none")]
+
+    if copy_video:
+        video_only = [f for f in video_only if _is_copyable_video(f)]
+        muxed = [f for f in muxed if _is_copyable_video(f)]
+
+    def video_preferred(f):
+        return (f.get("fps") or fps) >= fps and (f.get("vbr") or f.get("tbr") or video_kbps) >= video_kbps
+
+    def audio_sufficient(f):
+        return (f.get("abr") or f.get("tbr") or audio_kbps) >= audio_kbps
+
+    def audio_preferred(f):
+        return audio_codec is not None and str(f.get("acodec", "")).startswith(audio_codec)
+
+    video = _pick_video(video_only, target_short, video_preferred, duration)
+    audio = _pick(audio_only, audio_sufficient, duration, audio_preferred)
+
+    if video and audio:
+        selected = [video, audio]
+    elif not video_only and not muxed and audio:
+        # audio-only source, e.g. SoundCloud
+        selected = [audio]
+    else:
+        single = _pick_video(muxed, target_short, lambda f: video_preferred(f) and audio_sufficient(f), duration)
+        if single is None:
+            return None, []
+        selected = [single]
+
+    return "+".join(f["format_id"] for f in selected), selected
+
+
+def select_audio_formats(info, audio_kbps, audio_codec=None):
+    """Like select_formats, but only picks an audio stream; a muxed format is used if the source has no separate audio"""
+    duration = info.get("duration") or 0
+    formats = [f for f in info.get("formats") or [] if _usable(f)]
+    audio_only = [f for f in formats if f.get("vcodec") == "none" and f.get("acodec") != "none"]
+    muxed = [f for f in formats if f.get("acodec") not in (None, "none")]
+
+    def audio_sufficient(f):
+        return (f.get("abr") or f.get("tbr") or audio_kbps) >= audio_kbps
+
+    def audio_preferred(f):
+        return audio_codec is not None and str(f.get("acodec", "")).startswith(audio_codec)
+
+    audio = _pick(audio_only or muxed, audio_sufficient, duration, audio_preferred)
+    if audio is None:
+        return None, []
+    return audio["format_id"], [audio]
+
+
+def default_formats(info, width, height):
+    """Formats the previous `bestvideo[...]+bestaudio` filter would have chosen, used as a baseline for logging"""
+    formats = [f for f in info.get("formats") or [] if _usable(f)]
+    low, high = min(width, height), max(width, height)
+    videos = [
+        f for f in formats
+        if f.get("vcodec") != "none" and f.get("acodec") == "none" and _is_copyable_video(f)
+        and low <= (f.get("width") or 0) <= high and low <= (f.get("height") or 0) <= high
+    ]
+    audios = [f for f in formats if f.get("vcodec") == "none" and f.get("acodec") != "none"]
+    muxed_mp4 = [f for f in formats if f.get("ext") == "mp4" and f.get("vcodec") != "none" and f.get("acodec") != "none"]
+    if videos and audios:
+        return [max(videos, key=lambda f: f.get("tbr") or 0), max(audios, key=lambda f: f.get("abr") or f.get("tbr") or 0)]
+    if muxed_mp4:
+        return [max(muxed_mp4, key=lambda f: f.get("tbr") or 0)]
+    if audios:
+        return [max(audios, key=lambda f: f.get("abr") or f.get("tbr") or 0)]
+    return info.get("requested_formats") or []
+
+
+def log_selection(url, info, selected, baseline):
+    duration = info.get("duration") or 0
+    size = sum(estimate_size(f, duration) for f in selected)
+    baseline_size = sum(estimate_size(f, duration) for f in baseline)
+    logging.info(
+        f"Selected formats {'+'.join(f['format_id'] for f in selected)} for {url}: "
+        f"~{size / 1_000_000:.1f} MB, ~{max(0, baseline_size - size) / 1_000_000:.1f} MB less than default selection"
+    )
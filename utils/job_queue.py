@@ -0,0 +1,159 @@
+import json
+import time
+import sqlite3
+import logging
+from utils.config import Config
+
+
+class JobQueue:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._setup(Config().get("job_queue_db", "jobs.db"))
+        return cls._instance
+
+    def _setup(self, db_path):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs("
+                "identifier text PRIMARY KEY, params text, status text, worker text, playback_url text, "
+                "progress text, msgs text, res text, created_at real, updated_at real)"
+            )
+
+    def _connect(self):
+        # isolation_level=None lets claim() take the write lock itself with BEGIN IMMEDIATE
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def enqueue(self, identifier, params):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, 'queued', NULL, NULL, '', '[]', NULL, ?, ?)",
+                (identifier, json.dumps(params), now, now)
+            )
+        logging.info(f"Queued job {identifier}")
+
+    def claim(self, worker, playback_url):
+        """Atomically takes the oldest queued job. Returns (identifier, params) or None"""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT identifier, params FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, playback_url = ?, updated_at = ? WHERE identifier = ?",
+                (worker, playback_url, time.time(), row[0])
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        logging.info(f"Worker {worker} claimed job {row[0]}")
+        return row[0], json.loads(row[1])
+
+    def update(self, identifier, progress=None, msgs=None, res=None, status=None):
+        fields = {"updated_at": time.time()}
+        if progress is not None:
+            fields["progress"] = progress
+        if msgs is not None:
+            fields["msgs"] = json.dumps(msgs)
+        if res is not None:
+            fields["res"] = res
+        if status is not None:
+            fields["status"] = status
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE identifier = ?", (*fields.values(), identifier))
+
+    def get(self, identifier):
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM jobs WHERE identifier = ?", (identifier,)).fetchone()
+        return dict(row) if row else None
+
+    def cancel(self, identifier):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE identifier = ? AND status IN ('queued', 'running')",
+                (time.time(), identifier)
+            )
+
+    def is_cancelled(self, identifier):
+        job = self.get(identifier)
+        return job is None or job["status"] == "cancelled"
+
+    def locate(self, identifier):
+        """Returns base URL of the worker that produced the output, or None if it is served locally"""
+        job = self.get(identifier)
+        if job is None:
+            return None
+        return job["playback_url"] or None
+
+    def requeue_stale(self, timeout):
+        """Puts back jobs whose worker stopped reporting, e.g. because its host went down"""
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, playback_url = NULL "
+                "WHERE status = 'running' AND res IS NULL AND updated_at < ?",
+                (time.time() - timeout,)
+            )
+            if cur.rowcount:
+                logging.warning(f"Requeued {cur.rowcount} stale job(s)")
+
+
+class RemoteTask:
+    def __init__(self, identifier):
+        """
+        Stand-in for VideoProcessor when the conversion runs in a worker process.
+        Exposes the same attributes the routes poll, backed by the job queue.
+        """
+        self.identifier = identifier
+        # Previews stay on the worker; the job queue doesn't carry them
+        self.preview = None
+        self._seen_msgs = 0
+        self.last_seen = time.time()
+
+    def touch(self):
+        self.last_seen = time.time()
+
+    def _job(self):
+        return JobQueue().get(self.identifier) or {}
+
+    @property
+    def progress(self):
+        return self._job().get("progress") or ""
+
+    @property
+    def res(self):
+        job = self._job()
+        if job.get("status") == "cancelled":
+            return "err"
+        return job.get("res")
+
+    @property
+    def msg(self):
+        return json.loads(self._job().get("msgs") or "[]")
+
+    @property
+    def new_msg(self):
+        return len(self.msg) > self._seen_msgs
+
+    @new_msg.setter
+    def new_msg(self, value):
+        if not value:
+            self._seen_msgs = len(self.msg)
+
+    def start_conversion(self):
+        pass
+
+    def cancel(self):
+        JobQueue().cancel(self.identifier)
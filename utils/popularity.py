@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import sqlite3
+import logging
+import threading
+from utils.cleaner import Cleaner
+from utils.config import Config
+
+
+def profile_key(profile):
+    return json.dumps(profile, sort_keys=True)
+
+
+class CachedTask:
+    def __init__(self, file_ext, duration):
+        """Stand-in for VideoProcessor when the result was pre-transcoded; it's finished from the start"""
+        self.res = file_ext
+        self.duration = duration
+        self.progress = "Progress: 100%\n"
+        self.preview = None
+        self.new_msg = False
+        self.msg = []
+        self.processes = []
+        self.last_seen = time.time()
+
+    def touch(self):
+        pass
+
+    def start_conversion(self):
+        pass
+
+    def cancel(self):
+        pass
+
+
+class Popularity:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._setup()
+        return cls._instance
+
+    def _setup(self, db_path="data.db"):
+        self.db_path = db_path
+        self.half_life = Config().get("popularity_half_life", 24) * 3600
+        self.min_score = Config().get("popularity_min_score", 0.05)
+        self._lock = threading.Lock()
+        self._pruned_at = 0
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS popularity(url text, profile text, score real, updated_at real, PRIMARY KEY (url, profile))")
+            conn.execute("CREATE TABLE IF NOT EXISTS pretranscoded(url text, profile text, path text, expires_at real, PRIMARY KEY (url, profile))")
+            conn.commit()
+
+    def _decayed(self, score, updated_at, now):
+        return score * 0.5 ** ((now - updated_at) / self.half_life)
+
+    def record(self, url, profile=None, weight=1.0):
+        """Adds to the score of a source URL; profile is None for views that didn't convert anything (e.g. a result clicked)"""
+        key = profile_key(profile) if profile else ""
+        now = time.time()
+        with self._lock, sqlite3.connect(self.db_path) as conn:
+            row = conn.execute("SELECT score, updated_at FROM popularity WHERE url = ? AND profile = ?", (url, key)).fetchone()
+            score = weight + (self._decayed(row[0], row[1], now) if row else 0)
+            conn.execute("INSERT OR REPLACE INTO popularity VALUES (?, ?, ?, ?)", (url, key, score, now))
+            if now - self._pruned_at > 3600:
+                self._prune(conn, now)
+            conn.commit()
+
+    def _prune(self, conn, now):
+        """Forgets URLs nobody has watched for a long time and expired pre-transcodes"""
+        self._pruned_at = now
+        conn.create_function("decayed", 2, lambda score, updated_at: self._decayed(score, updated_at, now))
+        conn.execute("DELETE FROM popularity WHERE decayed(score, updated_at) < ?", (self.min_score,))
+        conn.execute("DELETE FROM pretranscoded WHERE expires_at < ?", (now,))
+
+    def top(self, urls_limit, profiles_limit):
+        """Most popular source URLs, and most used conversion profiles (as dicts)"""
+        now = time.time()
+        with sqlite3.connect(self.db_path) as conn:
+            rows = conn.execute("SELECT url, profile, score, updated_at FROM popularity").fetchall()
+        urls, profiles = {}, {}
+        for url, key, score, updated_at in rows:
+            score = self._decayed(score, updated_at, now)
+            urls[url] = urls.get(url, 0) + score
+            if key:
+                profiles[key] = profiles.get(key, 0) + score
+        top_urls = sorted(urls, key=urls.get, reverse=True)[:urls_limit]
+        top_profiles = sorted(profiles, key=profiles.get, reverse=True)[:profiles_limit]
+        return top_urls, [json.loads(key) for key in top_profiles]
+
+    def _pretranscoded(self, url, profile):
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute("SELECT path, expires_at FROM pretranscoded WHERE url = ? AND profile = ?", (url, profile_key(profile))).fetchone()
+        if row is None or row[1] < time.time() or not os.path.exists(row[0]):
+            return None
+        return row[0]
+
+    def serve(self, url, profile, identifier, duration):
+        """If the source was pre-transcoded with this profile, links the file into the identifier's directory"""
+        source = self._pretranscoded(url, profile)
+        if source is None:
+            return None
+        file_ext = source.rsplit(".", 1)[-1]
+        target_dir = os.path.join("cache", "content", identifier)
+        os.makedirs(target_dir, exist_ok=True)
+        target = os.path.join(target_dir, f"result.{file_ext}")
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+        logging.info(f"Serving pre-transcoded {url} to {identifier}")
+        return CachedTask(file_ext, duration)
+
+    @staticmethod
+    def _busy():
+        return any(task.res is None for task in list(Config().conv_tasks.values()))
+
+    def _pretranscode(self, url, profile):
+        from utils.tools_conv import VideoProcessor, get_video_length  # tools_conv uses this module
+
+        identifier = "pre-" + hashlib.sha1(f"{url}\n{profile_key(profile)}".encode()).hexdigest()
+        duration = get_video_length(url)
+        if duration > Config().get("pretranscode_max_duration", 1800):
+            return
+        Cleaner().remove_content_at(os.path.join("cache", "content", identifier))
+        task = VideoProcessor(url=url, identifier=identifier, allow_streaming=0, duration=duration, niceness=15, **profile)
+        logging.info(f"Pre-transcoding {url} while idle")
+        task.start_conversion()
+        while task.res is None:
+            # Real conversions always win
+            if any(other.res is None for key, other in list(Config().conv_tasks.items()) if key != identifier):
+                logging.info(f"Pre-transcoding of {url} interrupted by a conversion")
+                task.cancel()
+                while task.res is None:
+                    time.sleep(1)
+                Cleaner().remove_content_at(os.path.join("cache", "content", identifier))
+                return
+            time.sleep(1)
+        if task.res == "err":
+            return
+
+        path = os.path.join("cache", "content", identifier, f"result.{task.res}")
+        expires_at = time.time() + Config().get("pretranscode_lifetime", 24) * 3600
+        Cleaner().add_content(os.path.join("cache", "content", identifier), expires_at)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("INSERT OR REPLACE INTO pretranscoded VALUES (?, ?, ?, ?)", (url, profile_key(profile), path, expires_at))
+            conn.commit()
+
+    def run(self):
+        while True:
+            time.sleep(Config().get("pretranscode_interval", 300))
+            try:
+                if self._busy():
+                    continue
+                urls, profiles = self.top(Config().get("pretranscode_top_urls", 5), Config().get("pretranscode_top_profiles", 2))
+                for url in urls:
+                    for profile in profiles:
+                        if self._busy():
+                            break
+                        if self._pretranscoded(url, profile) is None:
+                            self._pretranscode(url, profile)
+            except Exception as e:
+                logging.error(f"Pre-transcoding failed: {e}")
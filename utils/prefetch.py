@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, CancelledError, TimeoutError
+from utils.config import Config
+
+
+class Prefetcher:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._setup()
+        return cls._instance
+
+    def _setup(self):
+        self.top_k = Config().get("prefetch_top_k", 0)
+        self.ttl = Config().get("prefetch_ttl", 300)
+        self._pool = ThreadPoolExecutor(max_workers=Config().get("prefetch_workers", 1), thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._cache = {}  # url -> (expires_at, info)
+        self._pending = {}  # url -> Future
+        self._procs = {}  # Popen -> url
+        self._wanted = set()  # URLs a conversion waits for; fetched even while busy
+
+    def schedule(self, urls):
+        """Queues metadata extraction for the first top_k URLs of a served result page"""
+        if not self.top_k or self._busy():
+            return
+        with self._lock:
+            for url in urls[:self.top_k]:
+                if url and url not in self._pending and self._cached(url) is None:
+                    self._pending[url] = self._pool.submit(self._fetch, url)
+
+    def get(self, url):
+        with self._lock:
+            return self._cached(url)
+
+    def put(self, url, info):
+        with self._lock:
+            self._cache[url] = (time.time() + self.ttl, info)
+
+    def wait(self, url, timeout=30):
+        """Metadata of a URL, waiting for its prefetch if one is queued or running; None if there's none"""
+        with self._lock:
+            future = self._pending.get(url)
+        if future is not None:
+            try:
+                future.result(timeout)
+            except (CancelledError, TimeoutError):
+                pass
+        return self.get(url)
+
+    def cancel_others(self, url):
+        """Drops queued and stops running prefetches of other URLs so they don't compete with the conversion of url"""
+        with self._lock:
+            if url in self._pending:
+                self._wanted.add(url)
+            for other, future in list(self._pending.items()):
+                if other != url and future.cancel():
+                    del self._pending[other]
+            for proc, other in self._procs.items():
+                if other != url:
+                    proc.terminate()
+
+    def _cached(self, url):
+        entry = self._cache.get(url)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self._cache[url]
+            return None
+        return entry[1]
+
+    @staticmethod
+    def _busy():
+        return any(task.res is None for task in list(Config().conv_tasks.values()))
+
+    def _fetch(self, url):
+        try:
+            if self._busy() and url not in self._wanted:
+                return
+            proc = subprocess.Popen(["yt-dlp", "-J", "--no-playlist", url], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            if hasattr(os, "setpriority"):
+                # Set from here, since preexec_fn isn't safe in a threaded server
+                try:
+                    os.setpriority(os.PRIO_PROCESS, proc.pid, min(19, os.getpriority(os.PRIO_PROCESS, 0) + 10))
+                except OSError:
+                    pass
+            with self._lock:
+                self._procs[proc] = url
+            stdout, _ = proc.communicate()
+            with self._lock:
+                self._procs.pop(proc, None)
+            if proc.returncode != 0:
+                return
+            self.put(url, json.loads(stdout))
+            logging.info(f"Prefetched metadata for {url}")
+        except Exception as e:
+            logging.warning(f"Prefetch of {url} failed: {e}")
+        finally:
+            with self._lock:
+                self._pending.pop(url, None)
+                self._wanted.discard(url)
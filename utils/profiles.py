@@ -0,0 +1,180 @@
+import os
+import re
+import time
+import yaml
+import socket
+import logging
+import threading
+from types import MappingProxyType
+from typing import NamedTuple
+from utils.config import Config
+
+bitrate_re = re.compile(r"^\d+(\.\d+)?[kKmM]?$")
+# Options that describe how audio is encoded; everything else is kept when audio is passed through
+AUDIO_ENCODING_ARGS = ("-c:a", "-ar", "-b:a", "-ac")
+# Video encoders that understand -preset, and what ffmpeg picks for a container when -c:v isn't given
+PRESET_ENCODERS = ("libx264", "libx265")
+DEFAULT_VIDEO_ENCODERS = {"mp4": "libx264", "mov": "libx264", "matroska": "libx264", "3gp": "h263", "asf": "msmpeg4",
+                          "avi": "mpeg4", "mpeg": "mpeg1video"}
+
+
+def tuned_profiles_path(config=None):
+    """Per-host file written by autotune.py"""
+    return os.path.join((config or Config().all()).get("tuned_profiles_dir", "tuned"), f"{socket.gethostname()}.yaml")
+
+
+def _validate_args(name, args):
+    if not isinstance(args, (list, tuple)) or not all(isinstance(arg, str) for arg in args):
+        raise ValueError(f"{name}: conversion command must be a list of strings")
+    if len(args) < 2 or args[-2] != "-f":
+        raise ValueError(f"{name}: conversion command must end with the output format (-f <format>)")
+    return tuple(args)
+
+
+def _output_variants(args):
+    """Precomputed output options for every (streaming, mono) combination"""
+    variants = {}
+    for streaming in (False, True):
+        for mono in (False, True):
+            variant = args[:-1] + (("matroska",) if streaming else args[-1:])
+            variants[(streaming, mono)] = variant + (("-ac", "1") if mono else ())
+    return MappingProxyType(variants)
+
+
+class VideoProfile(NamedTuple):
+    args: tuple
+    video_bitrate: str
+    audio_bitrate: str
+    file_ext: str
+    variants: dict
+
+    @classmethod
+    def from_config(cls, index, entry):
+        name = f"video_conv_commands[{index}]"
+        if not isinstance(entry, (list, tuple)) or len(entry) != 4:
+            raise ValueError(f"{name}: expected [conversion_command, video_bitrate, audio_bitrate, file_extension]")
+        args = _validate_args(name, entry[0])
+        for bitrate in entry[1:3]:
+            if not bitrate_re.match(str(bitrate)):
+                raise ValueError(f"{name}: invalid bitrate {bitrate}")
+        return cls(args, str(entry[1]), str(entry[2]), str(entry[3]), _output_variants(args))
+
+    def output_args(self, streaming=False, mono=False):
+        """Fresh list of output options; the profile itself is never modified"""
+        return list(self.variants[(bool(streaming), bool(mono))])
+
+    def video_encoder(self):
+        if "-c:v" in self.args:
+            return self.args[self.args.index("-c:v") + 1]
+        return DEFAULT_VIDEO_ENCODERS.get(self.args[-1])
+
+    def supports_preset(self):
+        return self.video_encoder() in PRESET_ENCODERS
+
+
+class AudioProfile(NamedTuple):
+    args: tuple
+    file_ext: str
+    variants: dict
+    passthrough_variants: dict
+
+    @classmethod
+    def from_config(cls, index, entry):
+        name = f"audio_conv_commands[{index}]"
+        if not isinstance(entry, (list, tuple)) or len(entry) != 2:
+            raise ValueError(f"{name}: expected [conversion_command, file_extension]")
+        args = _validate_args(name, entry[0])
+        container_args = []
+        for idx in range(0, len(args), 2):
+            if args[idx] not in AUDIO_ENCODING_ARGS:
+                container_args.extend(args[idx:idx + 2])
+        passthrough = ("-c:a", "copy", *container_args)
+        return cls(args, str(entry[1]), _output_variants(args), _output_variants(passthrough))
+
+    def output_args(self, streaming=False, mono=False, passthrough=False):
+        if passthrough:
+            return list(self.passthrough_variants[(bool(streaming), False)])
+        return list(self.variants[(bool(streaming), bool(mono))])
+
+
+class ProfileStore:
+    _instance = None
+
+    def __new__(cls, use_tuned=True):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.use_tuned = use_tuned
+            cls._instance._lock = threading.Lock()
+            cls._instance._last_check = 0
+            cls._instance._load()
+        return cls._instance
+
+    def _load(self):
+        self._video, self._audio = self._build(Config().all())
+        self._mtime = self._config_mtime()
+
+    def _build(self, config):
+        """Builds profiles from a parsed config; raises ValueError if any of them is invalid"""
+        video = tuple(VideoProfile.from_config(n, entry) for n, entry in enumerate(config.get("video_conv_commands") or []))
+        audio = tuple(AudioProfile.from_config(n, entry) for n, entry in enumerate(config.get("audio_conv_commands") or []))
+        if not video or not audio:
+            raise ValueError("video_conv_commands and audio_conv_commands can't be empty")
+        if self.use_tuned and config.get("tuned_profiles"):
+            video = self._apply_tuned(video, config)
+        return video, audio
+
+    @staticmethod
+    def _apply_tuned(video, config):
+        """Replaces commands of profiles measured on this host; entries tuned for a different command are skipped"""
+        path = tuned_profiles_path(config)
+        if not os.path.exists(path):
+            return video
+        with open(path) as file:
+            tuned = (yaml.safe_load(file) or {}).get("video") or {}
+        video = list(video)
+        for index, entry in tuned.items():
+            if not isinstance(index, int) or not 0 <= index < len(video):
+                continue
+            profile = video[index]
+            if list(entry.get("base") or []) != list(profile.args):
+                logging.warning(f"Tuned settings of video profile {index} were measured for a different command, run autotune.py again")
+                continue
+            video[index] = VideoProfile.from_config(index, [entry["args"], profile.video_bitrate, profile.audio_bitrate, profile.file_ext])
+        return tuple(video)
+
+    def _config_mtime(self):
+        paths = [Config().path] + ([tuned_profiles_path()] if self.use_tuned else [])
+        return max((os.path.getmtime(path) for path in paths if os.path.exists(path)), default=0)
+
+    def _maybe_reload(self):
+        if not Config().get("profile_hot_reload"):
+            return
+        now = time.time()
+        if now - self._last_check < Config().get("profile_reload_interval", 5):
+            return
+        with self._lock:
+            self._last_check = now
+            if self._config_mtime() == self._mtime:
+                return
+            try:
+                # Nothing is applied unless the whole file parses and every profile is valid
+                config = Config().read()
+                video, audio = self._build(config)
+                Config().reload(config)
+                self._video, self._audio = video, audio
+                self._mtime = self._config_mtime()
+                logging.info("Conversion profiles reloaded")
+            except Exception as e:
+                # Keep serving with the previous profiles
+                self._mtime = self._config_mtime()
+                logging.error(f"Invalid config, keeping the old one: {e}")
+
+    def video(self, device_type):
+        self._maybe_reload()
+        if device_type < 0 or device_type >= len(self._video):
+            device_type = 1
+        return self._video[device_type]
+
+    def audio(self, index):
+        self._maybe_reload()
+        return self._audio[index]
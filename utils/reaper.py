@@ -0,0 +1,46 @@
+import os
+import time
+import logging
+from utils.cleaner import Cleaner
+from utils.config import Config
+
+
+class Reaper:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.reaped = set()
+        return cls._instance
+
+    def reap(self):
+        """Cancels running conversions nobody has polled, streamed or downloaded for the grace period"""
+        grace = Config().get("abandon_grace_period", 60)
+        if not grace:
+            return
+        now = time.time()
+        forget_after = grace * Config().get("abandon_forget_multiplier", 10)
+        tasks = Config().conv_tasks
+        for identifier, task in list(tasks.items()):
+            if identifier in self.reaped:
+                if now - task.last_seen > forget_after:
+                    tasks.pop(identifier, None)
+                    self.reaped.discard(identifier)
+                continue
+            if task.res is not None or now - task.last_seen < grace:
+                continue
+            logging.info(f"Cancelling abandoned conversion {identifier}, last seen {now - task.last_seen:.0f}s ago")
+            task.cancel()
+            # The entry stays for a while, so a client that comes back sees an error instead of a missing task
+            self.reaped.add(identifier)
+            Cleaner().remove_content_at(os.path.join("cache", "content", identifier))
+        self.reaped.intersection_update(tasks)
+
+    def run(self):
+        while True:
+            time.sleep(Config().get("reaper_interval", 10))
+            try:
+                self.reap()
+            except Exception as e:
+                logging.error(f"Reaper failed: {e}")
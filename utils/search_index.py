@@ -0,0 +1,108 @@
+import re
+import time
+import sqlite3
+import logging
+import threading
+from utils.config import Config
+
+token_re = re.compile(r"\w+", re.UNICODE)
+
+
+class SearchIndex:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._setup()
+        return cls._instance
+
+    def _setup(self, db_path="data.db"):
+        self.db_path = db_path
+        self.max_entries = Config().get("search_index_max_entries", 20000)
+        self.max_age = Config().get("search_index_max_age", 30) * 24 * 3600
+        self._lock = threading.Lock()
+        self._added = 0
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS search_results(id INTEGER PRIMARY KEY, video_url text UNIQUE, title text, "
+                "creator text, length int, thumbnail_url text, source text, seen_at real)"
+            )
+            try:
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(title, creator)")
+                self.fts = True
+            except sqlite3.OperationalError:
+                logging.warning("SQLite has no FTS5, local search will use slower LIKE queries")
+                self.fts = False
+            conn.commit()
+
+    def enabled(self):
+        return self.max_entries > 0
+
+    def add(self, results, source):
+        """Stores results returned by search_yt or search_sc"""
+        if not self.enabled():
+            return
+        now = time.time()
+        with self._lock, sqlite3.connect(self.db_path) as conn:
+            for res in results:
+                if not res.get("video_url"):
+                    continue
+                row = conn.execute("SELECT id FROM search_results WHERE video_url = ?", (res["video_url"],)).fetchone()
+                values = (res.get("title") or "", res.get("creator") or "", res.get("length") or 0, res.get("thumbnail_url") or "", source, now)
+                if row:
+                    conn.execute(
+                        "UPDATE search_results SET title = ?, creator = ?, length = ?, thumbnail_url = ?, source = ?, seen_at = ? WHERE id = ?",
+                        values + (row[0],)
+                    )
+                    row_id = row[0]
+                    if self.fts:
+                        conn.execute("DELETE FROM search_fts WHERE rowid = ?", (row_id,))
+                else:
+                    row_id = conn.execute(
+                        "INSERT INTO search_results(title, creator, length, thumbnail_url, source, seen_at, video_url) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        values + (res["video_url"],)
+                    ).lastrowid
+                if self.fts:
+                    conn.execute("INSERT INTO search_fts(rowid, title, creator) VALUES (?, ?, ?)", (row_id, values[0], values[1]))
+            self._added += len(results)
+            if self._added >= 100:
+                self._added = 0
+                self._prune(conn)
+            conn.commit()
+
+    def _prune(self, conn):
+        expired = time.time() - self.max_age
+        conn.execute(
+            "DELETE FROM search_results WHERE seen_at < ? OR id NOT IN (SELECT id FROM search_results ORDER BY seen_at DESC LIMIT ?)",
+            (expired, self.max_entries)
+        )
+        if self.fts:
+            conn.execute("DELETE FROM search_fts WHERE rowid NOT IN (SELECT id FROM search_results)")
+
+    def search(self, query, source, page=0, max_results=10):
+        """Previously seen results matching every word of the query, best matches first"""
+        tokens = token_re.findall(query.lower())
+        if not tokens or not self.enabled():
+            return []
+        columns = "r.title, r.creator, r.length, r.video_url, r.thumbnail_url"
+        with sqlite3.connect(self.db_path) as conn:
+            if self.fts:
+                # Every word may be the beginning of a longer one, so partially typed queries still match
+                match = " ".join(f'"{token}"*' for token in tokens)
+                rows = conn.execute(
+                    f"SELECT {columns} FROM search_fts JOIN search_results r ON r.id = search_fts.rowid "
+                    "WHERE search_fts MATCH ? AND r.source = ? ORDER BY bm25(search_fts), r.seen_at DESC LIMIT ? OFFSET ?",
+                    (match, source, max_results, page * max_results)
+                ).fetchall()
+            else:
+                conditions = " AND ".join("(r.title LIKE ? OR r.creator LIKE ?)" for _ in tokens)
+                params = [value for token in tokens for value in (f"%{token}%", f"%{token}%")]
+                rows = conn.execute(
+                    f"SELECT {columns} FROM search_results r WHERE {conditions} AND r.source = ? ORDER BY r.seen_at DESC LIMIT ? OFFSET ?",
+                    params + [source, max_results, page * max_results]
+                ).fetchall()
+        return [
+            {"title": title, "creator": creator, "length": length, "video_url": video_url, "thumbnail_url": thumbnail_url}
+            for title, creator, length, video_url, thumbnail_url in rows
+        ]
@@ -0,0 +1,250 @@
+import os
+import math
+import time
+import shutil
+import hashlib
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from utils.admission import AdmissionControl
+from utils.config import Config
+from utils.profiles import ProfileStore
+from utils.source_cache import SourceCache
+from utils.tools_conv import probe_formats, approximate_bitrate, lower_priority
+from utils import format_selector
+
+
+class SegmentSession:
+    def __init__(self, identifier, url, dtype, width, height, fps, duration, client=None):
+        """
+        Transcodes a source into short MPEG-TS segments on demand, for clients that play HLS playlists.
+        While segments are being encoded, the session counts as one of the client's jobs for admission control.
+
+        Parameters:
+            identifier (str): Session identifier.
+            url (str): The URL of the video.
+            dtype (int): Device type; only bitrates are taken from its profile, codecs are always h264/aac.
+            width (int): Target width.
+            height (int): Target height.
+            fps (int): Target fps.
+            duration (int): Video duration in seconds; defines how many segments the playlist has.
+            client (str): Client address, for admission control.
+        """
+        self.identifier = identifier
+        self.client = client
+        self.video_url = url
+        self.dtype = dtype
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.duration = duration
+        self.segment_length = Config().get("segment_length", 6)
+        self.count = max(1, math.ceil(duration / self.segment_length))
+
+        profile = ProfileStore().video(dtype)
+        self.video_bitrate = profile.video_bitrate
+        if self.video_bitrate == "0k":
+            self.video_bitrate = approximate_bitrate(width, height, fps)
+        self.audio_bitrate = profile.audio_bitrate
+
+        # Segments are shared by everyone watching the same source with the same settings
+        self.key = hashlib.sha1(f"{url}\n{dtype}\n{width}x{height}@{fps}".encode()).hexdigest()
+        self.path = os.path.join("cache", "segments", self.key)
+        self.shared = Segmenter().shared_state(self.key, self.path, duration * Config().get("video_lifetime_multiplier"))
+
+        self.processes = []
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        # A client asking for many segments at once gets them encoded a few at a time
+        self._slots = threading.Semaphore(Config().get("segment_lookahead", 2) + 1)
+
+        self._input = None
+        self._input_ready = threading.Event()
+        threading.Thread(target=self._resolve_input, daemon=True).start()
+
+    @property
+    def res(self):
+        """None while segments are being encoded, like a running conversion"""
+        return None if self._in_flight else "ts"
+
+    def _resolve_input(self):
+        """Finds where to read the source from: a cached download or direct media URLs"""
+        try:
+            info = probe_formats(self.video_url)
+            format_spec, selected = format_selector.select_formats(
+                info, self.width, self.height, self.fps,
+                format_selector.parse_bitrate(self.video_bitrate), format_selector.parse_bitrate(self.audio_bitrate)
+            )
+            if format_spec is None:
+                selected = info.get("requested_formats") or [info]
+            cached = format_spec and SourceCache().lookup(self.video_url, format_spec)
+            if cached:
+                self._input = [["-i", cached]]
+            else:
+                self._input = []
+                for fmt in selected:
+                    headers = "".join(f"{key}: {value}\r\n" for key, value in (fmt.get("http_headers") or {}).items())
+                    self._input.append((["-headers", headers] if headers else []) + ["-i", fmt["url"]])
+        except Exception as e:
+            logging.error(f"Couldn't resolve source for segmented playback of {self.video_url}: {e}")
+        finally:
+            self._input_ready.set()
+
+    def playlist(self):
+        lines = [
+            "#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{self.segment_length}",
+            "#EXT-X-MEDIA-SEQUENCE:0", "#EXT-X-PLAYLIST-TYPE:VOD"
+        ]
+        for n in range(self.count):
+            length = min(self.segment_length, self.duration - n * self.segment_length)
+            lines.append(f"#EXTINF:{max(length, 0.1):.3f},")
+            lines.append(f"{n}.ts")
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def segment_path(self, n):
+        return os.path.join(self.path, f"{n}.ts")
+
+    def get_segment(self, n):
+        """Returns path to segment n, encoding it first if needed, and starts encoding the following ones"""
+        if n < 0 or n >= self.count:
+            raise IndexError(f"Segment {n} out of range")
+        self._ensure(n)
+        for ahead in range(n + 1, min(n + 1 + Config().get("segment_lookahead", 2), self.count)):
+            Segmenter().pool.submit(self._ensure, ahead)
+        if not os.path.exists(self.segment_path(n)):
+            raise FileNotFoundError(self.segment_path(n))
+        return self.segment_path(n)
+
+    def _ensure(self, n):
+        if os.path.exists(self.segment_path(n)):
+            return
+        # Other sessions with the same key write the same files, so they share the in-flight events
+        with self.shared.lock:
+            event = self.shared.encoding.get(n)
+            owner = event is None
+            if owner:
+                event = self.shared.encoding[n] = threading.Event()
+        if not owner:
+            event.wait()
+            return
+        try:
+            self._encode(n)
+        finally:
+            with self.shared.lock:
+                del self.shared.encoding[n]
+            event.set()
+
+    def _encode(self, n):
+        self._input_ready.wait()
+        if not self._input:
+            return
+        start = n * self.segment_length
+        inputs = []
+        for input_args in self._input:
+            # Seek every input before decoding, so a segment costs the same anywhere in the video
+            inputs.extend(["-ss", str(start), *input_args])
+        maps = ["-map", "0:v:0", "-map", f"{len(self._input) - 1}:a:0?"]
+        part_path = self.segment_path(n) + ".part"
+        os.makedirs(self.path, exist_ok=True)
+        with self._slots:
+            with self._in_flight_lock:
+                self._in_flight += 1
+            try:
+                threads, niceness = AdmissionControl().share(self.client)
+                AdmissionControl().track(self.client, self.identifier, self)
+                self._run_encoder(n, start, inputs, maps, part_path, threads, niceness)
+            finally:
+                with self._in_flight_lock:
+                    self._in_flight -= 1
+
+    def _run_encoder(self, n, start, inputs, maps, part_path, threads, niceness):
+        command = [
+            "ffmpeg", "-nostdin", "-loglevel", "error", "-y", *inputs, "-t", str(self.segment_length), *maps,
+            "-vf", f"scale='min({self.width},iw)':'min({self.height},ih)':force_original_aspect_ratio=decrease,"
+                   f"pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-r", str(self.fps), "-c:v", "libx264", "-preset", "veryfast", "-profile:v", "baseline", "-level", "3.0",
+            "-pix_fmt", "yuv420p", "-b:v", self.video_bitrate,
+            "-c:a", "aac", "-b:a", self.audio_bitrate, "-ar", "44100", "-ac", "2",
+            "-threads", str(threads), "-output_ts_offset", str(start), "-f", "mpegts", part_path
+        ]
+        started = time.time()
+        proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        lower_priority(proc, niceness)
+        self.processes.append(proc)
+        _, stderr = proc.communicate()
+        self.processes.remove(proc)
+        if proc.returncode != 0:
+            logging.error(f"Failed to encode segment {n} of {self.video_url}: {stderr.strip()}")
+            return
+        os.replace(part_path, self.segment_path(n))
+        logging.info(f"Encoded segment {n} of {self.video_url} in {time.time() - started:.1f}s")
+
+
+class SharedSegments:
+    def __init__(self, path):
+        """State of one segment directory, shared by all sessions with the same key"""
+        self.path = path
+        self.lock = threading.Lock()
+        self.encoding = {}  # segment number -> threading.Event
+        self.expires_at = 0
+
+
+class Segmenter:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.sessions = {}
+            cls._instance.shared = {}  # key -> SharedSegments
+            cls._instance._lock = threading.Lock()
+            cls._instance.pool = ThreadPoolExecutor(max_workers=Config().get("segment_workers", 2), thread_name_prefix="segment")
+            cls._instance._remove_leftovers()
+        return cls._instance
+
+    @staticmethod
+    def _remove_leftovers():
+        """Directories of sessions from before a restart; recently used ones may belong to another server process"""
+        root = os.path.join("cache", "segments")
+        if not os.path.isdir(root):
+            return
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if time.time() - os.path.getmtime(path) > 24 * 3600:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def shared_state(self, key, path, lifetime):
+        """State of a segment directory; it's kept for at least lifetime seconds from now"""
+        with self._lock:
+            if key not in self.shared:
+                self.shared[key] = SharedSegments(path)
+            shared = self.shared[key]
+            shared.expires_at = max(shared.expires_at, time.time() + lifetime)
+            return shared
+
+    def _prune(self):
+        """Removes expired directories together with every session using them"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, shared in self.shared.items() if shared.expires_at < now and not shared.encoding]
+            for key in expired:
+                shutil.rmtree(self.shared.pop(key).path, ignore_errors=True)
+            for identifier, session in list(self.sessions.items()):
+                if session.key in expired:
+                    del self.sessions[identifier]
+
+    def create(self, identifier, url, dtype, width, height, fps, duration, client=None):
+        self._prune()
+        session = SegmentSession(identifier, url, dtype, width, height, fps, duration, client)
+        self.sessions[identifier] = session
+        return session
+
+    def get(self, identifier):
+        """Session of an identifier; every use keeps its segments for another lifetime"""
+        self._prune()
+        session = self.sessions.get(identifier)
+        if session is not None:
+            self.shared_state(session.key, session.path, session.duration * Config().get("video_lifetime_multiplier"))
+        return session
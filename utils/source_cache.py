@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+from utils.config import Config
+
+
+class SourceCache:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._setup()
+        return cls._instance
+
+    def _setup(self, db_path="data.db"):
+        self.db_path = db_path
+        self.root = os.path.join("cache", "sources")
+        self.budget = Config().get("source_cache_size", 0) * 1024 * 1024
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sources(key text PRIMARY KEY, size int, last_access real)")
+            conn.execute("CREATE TABLE IF NOT EXISTS source_info(url text, key text, info text, PRIMARY KEY (url, key))")
+            conn.commit()
+
+    def enabled(self):
+        return self.budget > 0
+
+    @staticmethod
+    def make_key(url, format_spec):
+        return hashlib.sha1(f"{url}\n{format_spec}".encode()).hexdigest()
+
+    def lookup(self, url, format_spec):
+        """Returns path of a cached download, or None"""
+        if not self.enabled():
+            return None
+        key = self.make_key(url, format_spec)
+        media_path = os.path.join(self.root, key, "source")
+        if not os.path.exists(media_path):
+            return None
+
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("UPDATE sources SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+        logging.info(f"Source cache hit for {url}")
+        return media_path
+
+    def info(self, url):
+        """yt-dlp metadata saved with the most recently used cached source of a URL, or None"""
+        if not self.enabled():
+            return None
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT i.info FROM source_info i JOIN sources s ON s.key = i.key WHERE i.url = ? ORDER BY s.last_access DESC LIMIT 1",
+                (url,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def new_part(self):
+        """Path of a temporary file a download can be written to before commit()"""
+        return os.path.join(self.root, f"{uuid.uuid4()}.part")
+
+    def commit(self, url, format_spec, part_path, info=None):
+        key = self.make_key(url, format_spec)
+        entry_path = os.path.join(self.root, key)
+        with self._lock:
+            os.makedirs(entry_path, exist_ok=True)
+            os.replace(part_path, os.path.join(entry_path, "source"))
+            size = os.path.getsize(os.path.join(entry_path, "source"))
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (key, size, time.time()))
+                if info is not None:
+                    conn.execute("INSERT OR REPLACE INTO source_info VALUES (?, ?, ?)", (url, key, json.dumps(info)))
+                conn.commit()
+            logging.info(f"Cached source of {url} ({size} bytes)")
+            self._evict()
+
+    def discard(self, part_path):
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        with sqlite3.connect(self.db_path) as conn:
+            rows = conn.execute("SELECT key, size FROM sources ORDER BY last_access DESC").fetchall()
+            total = 0
+            for key, size in rows:
+                total += size
+                if total > self.budget:
+                    shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+                    conn.execute("DELETE FROM sources WHERE key = ?", (key,))
+                    conn.execute("DELETE FROM source_info WHERE key = ?", (key,))
+                    logging.info(f"Evicted cached source {key}")
+            conn.commit()
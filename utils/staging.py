@@ -0,0 +1,107 @@
+import os
+import errno
+import shutil
+import logging
+import threading
+from utils.config import Config
+
+
+def _process_alive(pid):
+    if os.name == "nt":
+        # os.kill would terminate it; assume it's alive, so nothing is removed under a running process
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _remove_stale(root):
+    """Removes staging areas of processes that are gone; other processes may share root"""
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.isdigit() and int(name) != os.getpid() and not _process_alive(int(name)):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+class Staging:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._setup()
+        return cls._instance
+
+    def _setup(self):
+        # Every process (the server, each worker) stages in its own directory named after its pid
+        pid = str(os.getpid())
+        ram_dir = Config().get("staging_ram_dir", "")
+        self.ram_root = os.path.join(ram_dir, "ourtube-staging", pid) if ram_dir else None
+        self.ram_budget = Config().get("staging_ram_size", 0) * 1024 * 1024
+        self.disk_root = os.path.join("cache", "staging", pid)
+        self.reservations = {}
+        self._lock = threading.Lock()
+        # Leftovers of conversions interrupted by a restart
+        _remove_stale(os.path.dirname(self.disk_root))
+        shutil.rmtree(self.disk_root, ignore_errors=True)
+        os.makedirs(self.disk_root, exist_ok=True)
+        if self.ram_root:
+            _remove_stale(os.path.dirname(self.ram_root))
+            shutil.rmtree(self.ram_root, ignore_errors=True)
+            try:
+                os.makedirs(self.ram_root, exist_ok=True)
+            except OSError as e:
+                logging.warning(f"Can't use {self.ram_root} for staging, outputs will be staged on disk: {e}")
+                self.ram_root = None
+
+    def _ram_fits(self, expected_bytes):
+        if not self.ram_root or not self.ram_budget:
+            return False
+        reserved = sum(size for path, size in self.reservations.values() if path.startswith(self.ram_root))
+        if reserved + expected_bytes > self.ram_budget:
+            return False
+        return shutil.disk_usage(self.ram_root).free > expected_bytes
+
+    def reserve(self, identifier, expected_bytes, ram=True):
+        """
+        Directory the conversion writes its output to until publish().
+        It's in RAM if allowed and the expected size fits into what's left of the budget, otherwise on disk.
+        """
+        with self._lock:
+            if identifier in self.reservations:
+                return self.reservations[identifier][0]
+            root = self.ram_root if ram and self._ram_fits(expected_bytes) else self.disk_root
+            path = os.path.join(root, identifier)
+            os.makedirs(path, exist_ok=True)
+            self.reservations[identifier] = (path, expected_bytes)
+        logging.debug(f"Staging {identifier} in {path} ({expected_bytes // 1024} KB expected)")
+        return path
+
+    def in_ram(self, identifier):
+        with self._lock:
+            reservation = self.reservations.get(identifier)
+        return bool(reservation and self.ram_root and reservation[0].startswith(self.ram_root))
+
+    def publish(self, identifier, file_name, target_dir):
+        """Moves a finished file into target_dir; it appears there complete or not at all"""
+        source = os.path.join(self.reservations[identifier][0], file_name)
+        target = os.path.join(target_dir, file_name)
+        os.makedirs(target_dir, exist_ok=True)
+        try:
+            os.replace(source, target)
+        except OSError:
+            # RAM staging is another filesystem, so copy next to the target first and rename that
+            shutil.copyfile(source, target + ".part")
+            os.replace(target + ".part", target)
+            os.remove(source)
+
+    def release(self, identifier):
+        with self._lock:
+            reservation = self.reservations.pop(identifier, None)
+        if reservation:
+            shutil.rmtree(reservation[0], ignore_errors=True)
@@ -0,0 +1,31 @@
+import time
+import threading
+
+
+class StartupTimer:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.started = time.perf_counter()
+            cls._instance.phases = []
+            cls._instance._lock = threading.Lock()
+        return cls._instance
+
+    def reset(self, started):
+        """Moves the start of the timeline back, e.g. to when the launcher script began executing"""
+        self.started = started
+
+    def record(self, phase, since):
+        """Records a phase that began at `since` (a time.perf_counter() value) and ends now"""
+        with self._lock:
+            self.phases.append((phase, since - self.started, time.perf_counter() - since))
+
+    def report(self):
+        with self._lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        lines = ["Startup time report (start offset, duration):"]
+        for phase, offset, duration in phases:
+            lines.append(f"  {phase:<28} +{offset * 1000:8.1f} ms {duration * 1000:9.1f} ms")
+        return "\n".join(lines)
@@ -0,0 +1,42 @@
+import time
+import logging
+import threading
+from utils.config import Config
+
+
+class ThroughputMonitor:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._setup()
+        return cls._instance
+
+    def _setup(self):
+        self._lock = threading.Lock()
+        self._estimates = {}  # client -> (kbps, updated_at)
+        # Weight of the newest sample in the rolling estimate
+        self.alpha = Config().get("throughput_smoothing", 0.3)
+        # Small transfers are dominated by latency and would underestimate the link
+        self.min_bytes = Config().get("throughput_min_bytes", 64 * 1024)
+        self.max_age = Config().get("throughput_max_age", 24 * 60 * 60)
+
+    def record(self, client, num_bytes, seconds):
+        if num_bytes < self.min_bytes or seconds <= 0:
+            return
+        kbps = num_bytes * 8 / 1000 / seconds
+        with self._lock:
+            previous = self._estimates.get(client)
+            if previous and time.time() - previous[1] < self.max_age:
+                kbps = self.alpha * kbps + (1 - self.alpha) * previous[0]
+            self._estimates[client] = (kbps, time.time())
+        logging.debug(f"Throughput estimate for {client}: {kbps:.1f} kbps")
+
+    def estimate(self, client):
+        """Rolling delivered throughput to a client in kbps, or None if unknown"""
+        with self._lock:
+            entry = self._estimates.get(client)
+        if entry is None or time.time() - entry[1] > self.max_age:
+            return None
+        return entry[0]
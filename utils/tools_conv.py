@@ -1,18 +1,37 @@
 import os
 import re
 import json
-import yt_dlp
+import base64
+import functools
+import itertools
+import tempfile
+import time
 import logging
 import threading
 import subprocess
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import tools_web
+from utils import tools_web, format_selector, bitrate_planner
+from utils.admission import AdmissionControl
 from utils.cleaner import Cleaner
-from utils.config import config_instance, Config
+from utils.config import Config
+from utils.job_queue import JobQueue, RemoteTask
+from utils.popularity import Popularity
+from utils.search_index import SearchIndex
+from utils.source_cache import SourceCache
+from utils.staging import Staging
+from utils.prefetch import Prefetcher
+from utils.throughput import ThroughputMonitor
+from utils.tracing import Tracer
+from utils.profiles import ProfileStore
 
 
-def handle_conversion(request_args, client_arp):
+# ffmpeg encoder names mapped to codec names yt-dlp reports for source formats
+AUDIO_CODEC_NAMES = {"libmp3lame": "mp3", "mp3": "mp3", "aac": "mp4a"}
+
+
+def handle_conversion(request_args, client_arp, client_addr=None, admit=True, default_preview=False):
     identifier = request_args.get("i")
     video_url = request_args.get("url")
 
@@ -29,12 +48,41 @@ def handle_conversion(request_args, client_arp):
         fp = tools_web.validate_int_arg(request_args, 'fp')
         duration = int(request_args.get("l", 0))
         mono = request_args.get("mono") == "1"
+        audio_only = request_args.get("ao") == "1"
+        adaptive_bitrate = request_args.get("abr") == "1"
+        sizing_mode = int(request_args.get("szm") or 0)
+        max_mb = float(request_args.get("mb") or 0)
+        if sizing_mode == bitrate_planner.SIZING_MAX_SIZE and max_mb <= 0:
+            raise ValueError(f"Invalid value for 'mb': {request_args.get('mb')}")
+        clip_start = int(request_args.get("ss") or 0)
+        clip_end = int(request_args.get("to") or 0)
+        if clip_start < 0 or (clip_end and clip_end <= clip_start):
+            raise ValueError(f"Invalid clip range: {clip_start}-{clip_end}")
+        preview = request_args.get("pv", "1" if default_preview else "0") == "1"
     except ValueError as e:
         # logging.error(e)
         return {"error": str(e)}
 
+    rejected = admit and AdmissionControl().admit(client_addr, identifier)
+    if rejected:
+        return {"error": rejected[0], "retry_after": rejected[1]}
+
+    # Conversions take priority over speculative metadata extraction, except the one for this video
+    Prefetcher().cancel_others(video_url)
+
     if not duration:
         duration = get_video_length(video_url)
+    if clip_start and duration and clip_start >= duration:
+        if admit:
+            AdmissionControl().refund(client_addr)
+        return {"error": f"Invalid clip range: {clip_start} is past the end of the video"}
+
+    # Only the clip is converted, so progress and lifetime are based on its length
+    if clip_end and clip_end < duration:
+        duration = clip_end
+    else:
+        clip_end = 0
+    duration = max(duration - clip_start, 1)
 
     if width < height:
         width, height = height, width
@@ -42,16 +90,41 @@ def handle_conversion(request_args, client_arp):
     if client_arp or Config().check_arp():
         video_url = "https://www.youtube.com/watch?v=XA8I5AG_7to"
 
+    bandwidth = ThroughputMonitor().estimate(client_addr) if adaptive_bitrate and client_addr else None
+    threads, niceness = AdmissionControl().share(client_addr)
+
     Cleaner().remove_content_at(os.path.join("cache", "content", identifier))
-    Config().add_conv_task(
-        identifier,
-        VideoProcessor(video_url, identifier, dtype, ap, mono, sm, width, height, fps, fp, duration)
-    )
+    profile = {
+        "dtype": dtype, "audio_profile": ap, "mono_audio": mono, "sm": sm, "width": width, "height": height,
+        "fps": fps, "audio_only": audio_only, "sizing_mode": sizing_mode, "max_mb": max_mb
+    }
+    params = profile | {
+        "url": video_url, "allow_streaming": fp, "duration": duration, "bandwidth_kbps": bandwidth,
+        "clip_start": clip_start, "clip_end": clip_end, "threads": threads, "niceness": niceness,
+        "preview": preview
+    }
+
+    # Whole videos with a fixed profile can be served from pre-transcoded popular content
+    cached_task = None
+    if not clip_start and not clip_end and bandwidth is None:
+        Popularity().record(video_url, profile, Config().get("popularity_conversion_weight", 3))
+        cached_task = Popularity().serve(video_url, profile, identifier, duration)
+
+    if cached_task:
+        Config().add_conv_task(identifier, cached_task)
+    elif Config().get("worker_mode"):
+        JobQueue().enqueue(identifier, params)
+        Config().add_conv_task(identifier, RemoteTask(identifier))
+    else:
+        Config().add_conv_task(identifier, VideoProcessor(identifier=identifier, **params))
+    if admit:
+        AdmissionControl().track(client_addr, identifier, Config().conv_tasks[identifier])
     Config().conv_tasks[identifier].start_conversion()
 
     return {"identifier": identifier, "duration": duration}
 
-def search_yt(query, page=0, max_results=10):
+def iter_search_yt(query, page=0, max_results=10):
+    """Yields results one by one, as soon as yt-dlp extracts them"""
     start_index = max_results*page
     end_index = start_index + max_results
 
@@ -61,26 +134,25 @@ def search_yt(query, page=0, max_results=10):
         'extract_flat': True,
     }
 
-    with yt_dlp.YoutubeDL(ydl_options) as ydl:
-        result = ydl.extract_info(f"ytsearch{end_index}:{query}", download=False)
-        entries = result['entries'][start_index:end_index]
-
-    results = []
-    for idx, entry in enumerate(entries):
-        try:
-            duration = int(entry.get('duration'))
-        except TypeError:
-            duration = 0
-        results.append({
-            'title': entry.get('title'),
-            'creator': entry.get('uploader'),
-            'length': duration,
-            'video_url': entry.get('url'),
-            'thumbnail_url': generate_yt_thumbnail_url(entry.get('url'))
-        })
-    return results
+    import yt_dlp  # heavy; imported on first use, launcher warms it up in background
 
-def search_sc(query, page=0, max_results=10):
+    with yt_dlp.YoutubeDL(ydl_options) as ydl:
+        # Unprocessed result keeps entries lazy, so the first ones arrive before the whole page is extracted
+        result = ydl.extract_info(f"ytsearch{end_index}:{query}", download=False, process=False)
+        for entry in itertools.islice(result['entries'], start_index, end_index):
+            try:
+                duration = int(entry.get('duration'))
+            except TypeError:
+                duration = 0
+            yield {
+                'title': entry.get('title'),
+                'creator': entry.get('uploader') or entry.get('channel'),
+                'length': duration,
+                'video_url': entry.get('url'),
+                'thumbnail_url': generate_yt_thumbnail_url(entry.get('url'))
+            }
+
+def iter_search_sc(query, page=0, max_results=10):
     start_index = max_results*page
     end_index = start_index + max_results
 
@@ -90,31 +162,44 @@ def search_sc(query, page=0, max_results=10):
         'force_generic_extractor': False,
     }
 
+    import yt_dlp
+
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        results = ydl.extract_info(f"scsearch{end_index}:{query}", download=False)
-        entries = results['entries'][start_index:end_index]
+        results = ydl.extract_info(f"scsearch{end_index}:{query}", download=False, process=False)
+        for entry in itertools.islice(results['entries'], start_index, end_index):
+            try:
+                duration = int(entry.get('duration'))
+            except TypeError:
+                duration = 0
+            try:
+                th_url = entry["thumbnails"][4]["url"]
+            except:
+                th_url = entry.get('url')
+            yield {
+                'title': entry.get('title'),
+                'creator': entry.get('uploader'),
+                'length': duration,
+                'video_url': entry.get('url'),
+                'thumbnail_url': th_url
+            }
 
-    res = []
-    for entry in entries:
-        try:
-            duration = int(entry.get('duration'))
-        except TypeError:
-            duration = 0
-        try:
-            th_url = entry["thumbnails"][4]["url"]
-        except:
-            th_url = entry.get('url')
-        res.append({
-            'title': entry.get('title'),
-            'creator': entry.get('uploader'),
-            'length': duration,
-            'video_url': entry.get('url'),
-            'thumbnail_url': th_url
-        })
+def search_yt(query, page=0, max_results=10):
+    results = list(iter_search_yt(query, page, max_results))
+    SearchIndex().add(results, "yt")
+    return results
 
+def search_sc(query, page=0, max_results=10):
+    res = list(iter_search_sc(query, page, max_results))
+    SearchIndex().add(res, "sc")
     return res
 
-def generate_ffmpeg_cmd_video(path, scale_method, device_type, screen_w, screen_h, fps, streaming_requested, mono_audio):
+def input_options(input_path, seek=None):
+    """Input arguments for ffmpeg; seek is (start, length) in seconds and is applied before decoding"""
+    if seek is None:
+        return ["-i", input_path]
+    return ["-ss", str(seek[0]), "-t", str(seek[1]), "-i", input_path]
+
+def generate_ffmpeg_cmd_video(path, scale_method, device_type, screen_w, screen_h, fps, streaming_requested, mono_audio, input_path="pipe:0", bandwidth_kbps=None, planned_kbps=None, seek=None):
     """Convert video using ffmpeg with specific arguments
     Device types: check in config.yaml
     Scale methods:
@@ -125,15 +210,22 @@ def generate_ffmpeg_cmd_video(path, scale_method, device_type, screen_w, screen_
     Streaming:
         If user made a request with RTSP or MKV support, container will be replaced with MKV.
         If this isn't fast enough in RTSP mode, video will be moved to a different container after conversion
+    Input:
+        Source is read from stdin unless input_path points to a local file (e.g. a cached download)
+        If seek is given, only that part of the input is converted
+    Bandwidth:
+        If client's measured throughput is given, bitrates are lowered so the file downloads faster than realtime
+    Planned bitrate:
+        Replaces profile's video bitrate; comes from content complexity or size limit (see bitrate_planner)
     """
 
     if (device_type == 1 or device_type > 4) and scale_method > 2:
         file_ext = "mp4"
         command = [
-            "ffmpeg", "-i", "pipe:0",
+            "ffmpeg", *input_options(input_path, seek),
             "-max_muxing_queue_size", "9999",
             "-c:v", "copy", "-c:a", "aac",
-            "-b:a", config_instance.get("video_conv_commands")[device_type][2],
+            "-b:a", ProfileStore().video(device_type).audio_bitrate,
             "-f", "mp4"
         ]
         if streaming_requested:
@@ -171,14 +263,10 @@ def generate_ffmpeg_cmd_video(path, scale_method, device_type, screen_w, screen_
     # compose scale_args
     scale_args = ["-vf", ",".join(filters)] if filters else []
 
-    if device_type > 11 or device_type < 0:
-        device_type = 1
-
-    t = config_instance.get("video_conv_commands")[device_type]
-    conv_args = t[0]
-    video_bitrate = t[1]
-    audio_bitrate = t[2]
-    file_ext = t[3]
+    profile = ProfileStore().video(device_type)
+    video_bitrate = profile.video_bitrate
+    audio_bitrate = profile.audio_bitrate
+    file_ext = profile.file_ext
 
     if device_type in (2, 5, 11):
         mono_audio = True
@@ -186,17 +274,22 @@ def generate_ffmpeg_cmd_video(path, scale_method, device_type, screen_w, screen_
     if video_bitrate == "0k":
         video_bitrate = approximate_bitrate(screen_w, screen_h, fps)
 
+    if planned_kbps:
+        video_bitrate = f"{round(planned_kbps)}k"
+
+    if bandwidth_kbps:
+        video_bitrate, audio_bitrate = fit_bitrate_to_throughput(video_bitrate, audio_bitrate, bandwidth_kbps, profile.args)
+
+    conv_args = profile.output_args(streaming_requested, mono_audio)
     if streaming_requested:
-        conv_args[-1] = "matroska"
         file_ext = "mkv"
-
-    if mono_audio:
-        conv_args.extend(["-ac", "1"])
+    # Only some encoders have presets; a profile (e.g. tuned by autotune.py) may set its own
+    preset_args = ["-preset", "fast"] if profile.supports_preset() and "-preset" not in conv_args else []
 
     command = [
         "ffmpeg", "-y",
-        "-i", "pipe:0",
-        "-preset", "fast",
+        *input_options(input_path, seek),
+        *preset_args,
         "-max_muxing_queue_size", "9999",
         "-b:v", video_bitrate,
         "-b:a", audio_bitrate,
@@ -206,8 +299,10 @@ def generate_ffmpeg_cmd_video(path, scale_method, device_type, screen_w, screen_
     ]
     return command, file_ext
 
-def generate_ffmpeg_cmd_audio(path, device_type, audio_profile, mono, streaming):
+def audio_profile_index(device_type, audio_profile):
+    """Returns index into audio_conv_commands for a device type and audio profile, and whether it needs mono"""
     t = 0
+    mono = False
 
     if device_type in (2, 3):
         if audio_profile == 2:
@@ -229,22 +324,54 @@ def generate_ffmpeg_cmd_audio(path, device_type, audio_profile, mono, streaming)
         t = 3
         mono = True
 
-    conv_args, file_ext = config_instance.get("audio_conv_commands")[t]
-    if streaming:
-        conv_args[-1] = "matroska"
-        file_ext = "mkv"
-    if mono:
-        conv_args.extend(["-ac", "1"])
+    return t, mono
+
+def get_ffmpeg_arg(args, name):
+    """Value following `name` in an ffmpeg argument list, or None"""
+    try:
+        return args[args.index(name) + 1]
+    except (ValueError, IndexError):
+        return None
+
+def can_passthrough_audio(fmt, device_type, audio_profile, mono):
+    """Checks if the source audio format already matches the target profile, so it can be copied as is"""
+    t, force_mono = audio_profile_index(device_type, audio_profile)
+    conv_args = ProfileStore().audio(t).args
+    source_codec = AUDIO_CODEC_NAMES.get(get_ffmpeg_arg(conv_args, "-c:a"))
+    if source_codec is None or not str(fmt.get("acodec", "")).startswith(source_codec):
+        return False
+    if (mono or force_mono) and fmt.get("audio_channels") != 1:
+        return False
+    sample_rate = get_ffmpeg_arg(conv_args, "-ar")
+    if sample_rate and fmt.get("asr") != int(sample_rate):
+        return False
+    target_kbps = format_selector.parse_bitrate(get_ffmpeg_arg(conv_args, "-b:a") or 0)
+    if target_kbps and (fmt.get("abr") or fmt.get("tbr") or 0) > target_kbps * 1.1:
+        return False
+    return True
+
+def generate_ffmpeg_cmd_audio(path, device_type, audio_profile, mono, streaming, input_path="pipe:0", passthrough=False, seek=None):
+    """
+    Passthrough:
+        Source audio is copied without re-encoding; only container options of the profile are kept
+    """
+    t, force_mono = audio_profile_index(device_type, audio_profile)
+    mono = mono or force_mono
 
-    return ["ffmpeg", "-y", "-i", "pipe:0", *conv_args, os.path.join(path, f"result.{file_ext}")], file_ext
+    profile = ProfileStore().audio(t)
+    conv_args = profile.output_args(streaming, mono, passthrough)
+    file_ext = "mkv" if streaming else profile.file_ext
 
-def recontainer_video(path, device_type):
+    return ["ffmpeg", "-y", *input_options(input_path, seek), "-vn", *conv_args, os.path.join(path, f"result.{file_ext}")], file_ext
+
+def recontainer_video(path, device_type, output_path=None):
+    """Moves result.mkv in path to the device's container; the new file is written to output_path (path by default)"""
     if device_type > 4:
         device_type = 1
     file_exts = ["3gp", "mp4", "3gp", "3gp", "wmv"]
     container_names = ["3gp", "mp4", "3gp", "3gp", "asf"]
     file_ext = file_exts[device_type]
-    proc = subprocess.Popen(["ffmpeg", "-loglevel", "error", "-i", os.path.join(path, "result.mkv"), "-f", container_names[device_type], os.path.join(path, f"result.{file_ext}")])
+    proc = subprocess.Popen(["ffmpeg", "-loglevel", "error", "-i", os.path.join(path, "result.mkv"), "-f", container_names[device_type], os.path.join(output_path or path, f"result.{file_ext}")])
     proc.communicate()
     os.remove(os.path.join(path, "result.mkv"))
     return file_ext
@@ -260,6 +387,60 @@ def prepare_thumbnail(thumbnail_url, idx, thumbnail_id):
     except Exception as e:
         logging.error(f"An error occurred during downloading thumbnail: {e}")
 
+def fetch_thumbnail_tile(thumbnail_url, output_path, width, height, quality=5):
+    """Downloads a thumbnail scaled and padded to exactly width x height. Returns True on success"""
+    scale = f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2"
+    result = subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-i", thumbnail_url, "-vf", scale, "-frames:v", "1", "-q:v", str(quality), output_path, "-y"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return result.returncode == 0
+
+def prepare_thumbnail_sprite(thumbnail_urls, work_dir, tile_w=96, tile_h=54):
+    """
+    Fetches thumbnails concurrently and stacks them vertically into one JPEG.
+    Tiles that couldn't be fetched are left black so offsets stay predictable.
+    Returns path to the sprite and a list of (x, y) offsets, one per URL.
+    """
+    tile_paths = [os.path.join(work_dir, f"tile_{n}.jpg") for n in range(len(thumbnail_urls))]
+    with ThreadPoolExecutor(max_workers=Config().get("thumbnail_workers", 8)) as pool:
+        fetched = list(pool.map(
+            lambda args: fetch_thumbnail_tile(*args, tile_w, tile_h),
+            zip(thumbnail_urls, tile_paths)
+        ))
+
+    inputs = []
+    for path, ok in zip(tile_paths, fetched):
+        if ok:
+            inputs.extend(["-i", path])
+        else:
+            inputs.extend(["-f", "lavfi", "-i", f"color=c=black:s={tile_w}x{tile_h}"])
+
+    sprite_path = os.path.join(work_dir, "sprite.jpg")
+    stack = ["-filter_complex", f"vstack=inputs={len(tile_paths)}"] if len(tile_paths) > 1 else []
+    subprocess.run(["ffmpeg", "-loglevel", "error", *inputs, *stack, "-frames:v", "1", "-q:v", "5", sprite_path, "-y"], check=True)
+
+    offsets = [(0, n * tile_h) for n in range(len(tile_paths))]
+    return sprite_path, offsets
+
+@functools.cache
+def thumbnail_pool():
+    """Pool shared by all requests that embed thumbnails"""
+    return ThreadPoolExecutor(max_workers=Config().get("thumbnail_workers", 8), thread_name_prefix="thumbnail")
+
+def inline_thumbnail(thumbnail_url, tile_w=48, tile_h=27):
+    """Tiny base64 data URI of a thumbnail to embed into result pages; an empty string if it failed"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, "img.jpg")
+        if not thumbnail_url or not fetch_thumbnail_tile(thumbnail_url, path, tile_w, tile_h, quality=15):
+            return ""
+        with open(path, "rb") as f:
+            return "data:image/jpeg;base64," + base64.b64encode(f.read()).decode()
+
+def inline_thumbnails(thumbnail_urls):
+    futures = [thumbnail_pool().submit(inline_thumbnail, thumbnail_url) for thumbnail_url in thumbnail_urls]
+    return [future.result() for future in futures]
+
 def generate_yt_thumbnail_url(url):
     if 'v=' in url:
         video_id = url.split('v=')[1].split('&')[0]
@@ -271,7 +452,19 @@ def generate_yt_thumbnail_url(url):
     # Construct the fastest thumbnail URL (smallest size)
     return f"https://img.youtube.com/vi/{video_id}/default.jpg"
 
+def probe_formats(url):
+    """Full metadata of a video including the list of available formats"""
+    info = Prefetcher().wait(url)
+    if info is not None:
+        logging.info(f"Using prefetched metadata for {url}")
+        return info
+    result = subprocess.run(["yt-dlp", "-J", "--no-playlist", url], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return json.loads(result.stdout)
+
 def get_video_length(url):
+    info = Prefetcher().wait(url)
+    if info and info.get("duration"):
+        return int(info["duration"])
     try:
         result = subprocess.run(['yt-dlp', '--skip-download', '--print', '"%duration"', url],
                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
@@ -315,8 +508,63 @@ def approximate_bitrate(width, height, fps):
     return str(round(bitrate_kbps, 2)) + "k"
 
 
+def fit_bitrate_to_throughput(video_bitrate, audio_bitrate, bandwidth_kbps, conv_args):
+    """Lowers profile bitrates so that video plus audio fit into a share of client's throughput"""
+    budget = bandwidth_kbps * Config().get("abr_safety_factor", 0.8)
+    video_kbps = format_selector.parse_bitrate(video_bitrate)
+    audio_kbps = format_selector.parse_bitrate(audio_bitrate)
+    if video_kbps + audio_kbps <= budget:
+        return video_bitrate, audio_bitrate
+
+    # AMR-NB only supports a few fixed bitrates, so leave it alone
+    if get_ffmpeg_arg(conv_args, "-c:a") != "libopencore_amrnb":
+        audio_kbps = min(audio_kbps, max(budget * 0.2, 8))
+    video_kbps = max(budget - audio_kbps, Config().get("abr_min_video_bitrate", 24))
+    logging.info(f"Lowered bitrate to {video_kbps:.0f}k video, {audio_kbps:.0f}k audio for {bandwidth_kbps:.0f} kbps link")
+    return f"{round(video_kbps)}k", f"{round(audio_kbps, 1)}k"
+
+
+def lower_priority(proc, niceness):
+    """Makes a started process this much nicer than the server; preexec_fn could deadlock the child in a threaded server"""
+    if not niceness or not hasattr(os, "setpriority"):
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, proc.pid, min(19, os.getpriority(os.PRIO_PROCESS, 0) + niceness))
+    except OSError as e:
+        logging.warning(f"Couldn't lower priority of process {proc.pid}: {e}")
+
+
+def override_args(command, args):
+    """Replaces values of output options in an ffmpeg command, adding the missing ones before the output path"""
+    for name, value in args.items():
+        if name in command:
+            command[command.index(name) + 1] = value
+        else:
+            command[-1:-1] = [name, value]
+
+
+def degrade_for_streaming(width, height, fps, step, supports_preset):
+    """
+    Cheaper encoder settings for streaming that can't keep up with realtime.
+    Returns width, height, fps and output options to override; each step keeps the savings of the previous ones:
+        1: fastest scaler, and fastest preset if the encoder has presets
+        2: 2/3 of the frame rate
+        3+: 3/4 of the resolution per step
+    """
+    extra_args = {}
+    if step >= 1:
+        extra_args = {"-sws_flags": "fast_bilinear"}
+        if supports_preset:
+            extra_args["-preset"] = "ultrafast"
+    if step >= 2:
+        fps = max(8, fps * 2 // 3)
+    for _ in range(step - 2):
+        width, height = max(96, int(width * 0.75) // 4 * 4), max(64, int(height * 0.75) // 4 * 4)
+    return width, height, fps, extra_args
+
+
 class VideoProcessor:
-    def __init__(self, url, identifier, dtype, audio_profile, mono_audio, sm, width, height, fps, allow_streaming, duration):
+    def __init__(self, url, identifier, dtype, audio_profile, mono_audio, sm, width, height, fps, allow_streaming, duration, audio_only=False, bandwidth_kbps=None, sizing_mode=0, max_mb=0, clip_start=0, clip_end=0, threads=0, niceness=0, preview=False):
         """
         Downloads the worst quality video that meets the specified width and height using yt-dlp and converts it further.
 
@@ -332,6 +580,15 @@ class VideoProcessor:
             fps (int): Target fps of a video.
             allow_streaming (bool): Allow streaming with this video file while it's not fully converted.
             duration (int): Target video duration. Used for calculating progress.
+            audio_only (bool): Download and convert only the audio stream, even if the source has video.
+            bandwidth_kbps (float): Measured throughput to the client; if set, bitrates are fitted to it.
+            sizing_mode (int): How to pick video bitrate; Look at bitrate_planner for details.
+            max_mb (float): Maximum output size in megabytes for the size-limited sizing mode.
+            clip_start (int): Start of the part to convert, in seconds.
+            clip_end (int): End of the part to convert, in seconds; 0 means the end of the video.
+            threads (int): Encoder threads; 0 lets ffmpeg decide.
+            niceness (int): Scheduling priority of the encoder; higher is lower priority.
+            preview (bool): Also make a cheap rendition of the first seconds, playable while the rest converts.
         """
 
         self.video_url = url
@@ -345,107 +602,202 @@ class VideoProcessor:
         self.duration = duration
         self.audio_profile = audio_profile
         self.mono_audio = mono_audio
+        self.audio_only = audio_only
+        self.bandwidth_kbps = bandwidth_kbps
+        self.sizing_mode = sizing_mode
+        self.max_mb = max_mb
+        self.clip_start = clip_start
+        self.clip_end = clip_end
+        self.threads = threads
+        self.niceness = niceness
+        self.make_preview = preview
 
         self.progress = ""
+        self.preview = None
         self.res = None
         self.new_msg = False
         self.msg = []
         self.processes = []
+        self.cancelled = False
+        self.last_seen = time.time()
+        self._preview_proc = None
+        self._preview_thread = None
+        self._info = None
+        self._tee_lock = threading.Lock()
+        self._teeing = False
+        self._next_encoder = None
+        self._stage_on_disk = False
+
+    def touch(self):
+        """Marks that a client is still waiting for this conversion"""
+        self.last_seen = time.time()
 
     def start_conversion(self):
-        threading.Thread(target = self._convert).start()
+        threading.Thread(target = self._traced_convert).start()
+
+    def _traced_convert(self):
+        with Tracer().bound(self.identifier), Tracer().span("conversion"):
+            self._convert()
+            if self.res is None and self._stage_on_disk:
+                self.progress = ""
+                self.make_preview = self.make_preview and self.preview is None
+                self._convert()
 
     def _convert(self):
         try:
             video_path = os.path.join("cache", "content", self.identifier)
             os.makedirs(video_path, exist_ok=True)
 
-            format_filter = (
-                f"bestvideo[ext=mp4][vcodec^=avc1]"
-                f"[height>={min(self.height, self.width)}][width>={min(self.width, self.height)}]"
-                f"[height<={max(self.height, self.width)}][width<={max(self.width, self.height)}]"
-                f"+bestaudio/mp4/bestaudio"
-            )
-
-            result = subprocess.run(["yt-dlp", "-f", format_filter, "--print-json", "--simulate", self.video_url], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            info = json.loads(result.stdout)
-
-            requested_formats = info.get("requested_formats")
-            if requested_formats:
-                # video + audio selected
-                has_video = any(f.get("vcodec") != "none" for f in requested_formats)
-                has_audio = any(f.get("acodec") != "none" for f in requested_formats)
-            else:
-                # single format selected (could be audio only)
-                has_video = info.get("vcodec") != "none"
-                has_audio = info.get("acodec") != "none"
-
-            if has_audio and not has_video:
+            # Metadata saved with a cached source skips yt-dlp, as long as it still selects that source
+            info = SourceCache().info(self.video_url)
+            input_path = None
+            if info is not None:
+                format_spec, selected = self._choose_formats(info)
+                input_path = SourceCache().lookup(self.video_url, format_spec)
+            if input_path is None:
+                with Tracer().span("probe"):
+                    info = probe_formats(self.video_url)
+                format_spec, selected = self._choose_formats(info)
+                input_path = SourceCache().lookup(self.video_url, format_spec) or "pipe:0"
+            self._info = info
+            cached = input_path != "pipe:0"
+            clip = bool(self.clip_start or self.clip_end)
+            # A cached source is seeked by ffmpeg; downloads are limited to the clip by yt-dlp instead
+            seek = (self.clip_start, self.duration) if clip and cached else None
+
+            video_format = next((f for f in selected if f.get("vcodec") not in (None, "none")), None)
+            has_video = video_format is not None
+            has_audio = any(f.get("acodec") not in (None, "none") for f in selected)
+
+            audio_path = has_audio and (self.audio_only or not has_video)
+            if audio_path:
                 self.allow_streaming = self.allow_streaming == 1
-                ffmpeg_cmd, file_ext = generate_ffmpeg_cmd_audio(video_path, self.dtype, self.audio_profile, self.mono_audio, self.allow_streaming)
+            # Files played while they're written stay in place; others are staged and published when complete
+            output_path = video_path if self.allow_streaming else Staging().reserve(self.identifier, self._expected_size(selected), ram=not self._stage_on_disk)
+
+            if audio_path:
+                audio_format = next(f for f in selected if f.get("acodec") not in (None, "none"))
+                passthrough = len(selected) == 1 and can_passthrough_audio(audio_format, self.dtype, self.audio_profile, self.mono_audio)
+                if passthrough:
+                    logging.info(f"Passing through source audio of {self.video_url}")
+                ffmpeg_cmd, file_ext = generate_ffmpeg_cmd_audio(output_path, self.dtype, self.audio_profile, self.mono_audio, self.allow_streaming, input_path, passthrough, seek)
             elif has_video:
-                if info.get("width") < info.get("height"):
+                if (video_format.get("width") or 0) < (video_format.get("height") or 0):
                     self.width, self.height = self.height, self.width
-                ffmpeg_cmd, file_ext = generate_ffmpeg_cmd_video(video_path, self.sm, self.dtype, self.width, self.height, self.fps, self.allow_streaming, self.mono_audio)
+                with Tracer().span("plan bitrate"):
+                    planned_kbps = self._plan_bitrate(video_format, input_path)
             else:
                 self.res = "err"
                 return
 
-            ydl_cmd = ["yt-dlp", "--quiet", "-f", format_filter, "-o", "-", self.video_url]
-
-            self.processes.append(subprocess.Popen(ydl_cmd, stdout=subprocess.PIPE))
-            self.processes.append(subprocess.Popen(ffmpeg_cmd, stdin=self.processes[0].stdout, stderr=subprocess.PIPE, universal_newlines=True, bufsize=1))
+            copy_video = (self.dtype == 1 or self.dtype > 4) and self.sm > 2
+            # Streaming of an encoded video can trade quality for speed instead of giving up streaming
+            can_degrade = not audio_path and not copy_video and self.allow_streaming and Config().get("stream_degrade")
+            degrade_step = 0
 
-            self.processes[0].stdout.close()  # Let yt-dlp handle SIGPIPE if ffmpeg exits
+            # Streamed files are playable right away anyway, and short videos are converted before a preview would help
+            if self.make_preview and not self.allow_streaming and not audio_path and not copy_video and self.duration >= Config().get("preview_min_duration", 120):
+                self._start_preview(selected, input_path, output_path, planned_kbps)
 
-            speed_deque = deque(maxlen=3)
             speed_re = re.compile(r"speed=\s*([\d.]+)x")
             progress_re = re.compile(r"time=\s*(\S+)")
-            streaming_checked = False
-            have_to_recontainer = False
-            i = 0
-
-            for line in self.processes[1].stderr:
-                # print(line)
-
-                # measure speed for streaming
-                if len(speed_deque) < 3:
-                    speed_match = speed_re.search(line)
-                    if speed_match:
-                        speed = float(speed_match.group(1))
-                        if i > 0:
-                            speed_deque.append(speed)
-                        i += 1
-
-                # After collecting enough speed samples, decide on RTSP
-                if not streaming_checked and len(speed_deque) == 3 and self.allow_streaming:
-                    streaming_checked = True
-                    avg_speed = sum(speed_deque) / 3
-                    if avg_speed > 1.5:
-                        self.res = "mkv"
-                        return
-                    else:
-                        have_to_recontainer = True
-                        self.msg.append("Msg: Conversion too slow; Switching to regular mode\n")
-                        self.new_msg = True
-
-                # Get progress info for progress bars
-                prog_match = progress_re.search(line)
-                if prog_match:
-                    progress = ffmpeg_time_to_seconds(prog_match.group(1))
-                    self.progress = f"Progress: {int(progress * 100 / self.duration)}%\n"
+            downloader = encoder = None
+            while True:
+                if self.cancelled:
+                    # Cancelled while probing or restarting; nothing is running
+                    self.res = "err"
+                    return
+
+                if not audio_path:
+                    width, height, fps, extra_args = degrade_for_streaming(self.width, self.height, self.fps, degrade_step, ProfileStore().video(self.dtype).supports_preset())
+                    ffmpeg_cmd, file_ext = generate_ffmpeg_cmd_video(output_path, self.sm, self.dtype, width, height, fps, self.allow_streaming, self.mono_audio, input_path, self.bandwidth_kbps, planned_kbps, seek)
+                    override_args(ffmpeg_cmd, extra_args)
+                if self.threads:
+                    # Also replaces a thread count saved by an older autotune; the admission share knows about other jobs
+                    override_args(ffmpeg_cmd, {"-threads": str(self.threads)})
+
+                if encoder is not None:
+                    encoder = self._restart_encoder(encoder, ffmpeg_cmd)
+                if encoder is None:
+                    downloader, encoder = self._spawn(ffmpeg_cmd, format_spec, cached, clip)
+
+                spawned_at = time.time()
+                first_progress_at = None
+                speed_deque = deque(maxlen=3)
+                streaming_checked = False
+                have_to_recontainer = False
+                degrade = False
+                i = 0
+
+                for line in encoder.stderr:
+                    # print(line)
+
+                    # measure speed for streaming
+                    if len(speed_deque) < 3:
+                        speed_match = speed_re.search(line)
+                        if speed_match:
+                            speed = float(speed_match.group(1))
+                            if i > 0:
+                                speed_deque.append(speed)
+                            i += 1
+
+                    # After collecting enough speed samples, decide on RTSP
+                    if not streaming_checked and len(speed_deque) == 3 and self.allow_streaming:
+                        streaming_checked = True
+                        avg_speed = sum(speed_deque) / 3
+                        if avg_speed > 1.5:
+                            self.res = "mkv"
+                            return
+                        elif can_degrade and degrade_step < Config().get("stream_degrade_steps", 4):
+                            degrade = True
+                            logging.info(f"Streaming {self.identifier} at {avg_speed:.2f}x, restarting with cheaper settings (step {degrade_step + 1})")
+                            break
+                        else:
+                            have_to_recontainer = True
+                            self.msg.append("Msg: Conversion too slow; Switching to regular mode\n")
+                            self.new_msg = True
+
+                    # Get progress info for progress bars
+                    prog_match = progress_re.search(line)
+                    if prog_match:
+                        if first_progress_at is None:
+                            first_progress_at = time.time()
+                            Tracer().record("wait for first data", spawned_at, first_progress_at)
+                        progress = ffmpeg_time_to_seconds(prog_match.group(1))
+                        self.progress = f"Progress: {int(progress * 100 / self.duration)}%\n"
+
+                if not degrade:
+                    break
+                # Nothing was played yet, and a teed download goes on, so starting over costs only the seconds spent measuring
+                Tracer().record(f"streaming too slow, step {degrade_step + 1}", spawned_at, time.time())
+                degrade_step += 1
+                self.progress = ""
+                self.msg.append("Msg: Conversion too slow; Lowering quality to keep streaming\n")
+                self.new_msg = True
 
             # Wait for processes to finish
-            self.processes[1].communicate()
-            self.processes[0].wait()
-
-            if self.processes[0].returncode != 0 or self.processes[1].returncode != 0:
+            encoder.communicate()
+            if downloader:
+                downloader.wait()
+            Tracer().record("encode", first_progress_at or spawned_at, time.time())
+
+            if (downloader and downloader.returncode != 0) or encoder.returncode != 0:
+                if encoder.returncode != 0 and Staging().in_ram(self.identifier) and not self.cancelled:
+                    # Most likely the RAM staging area filled up because outputs outgrew their estimates
+                    logging.warning(f"Encoding {self.identifier} in RAM staging failed, retrying with disk staging")
+                    self._stage_on_disk = True
+                    return
                 logging.error(f"One of the processes exited with non-zero code")
                 self.res = "err"
                 return
 
             if have_to_recontainer:
-                recontainer_video(video_path, self.dtype)
+                output_path = Staging().reserve(self.identifier, os.path.getsize(os.path.join(video_path, "result.mkv")), ram=not self._stage_on_disk)
+                with Tracer().span("recontainer"):
+                    file_ext = recontainer_video(video_path, self.dtype, output_path)
+            if output_path != video_path:
+                with Tracer().span("publish"):
+                    Staging().publish(self.identifier, f"result.{file_ext}", video_path)
 
             logging.info(f"Successfully downloaded video to {video_path}")
             self.res = file_ext
@@ -455,7 +807,257 @@ class VideoProcessor:
             logging.error(f"An error occurred while downloading the video: {e}")
             self.res = "err"
             return
+        finally:
+            self._stop_preview()
+            Staging().release(self.identifier)
+
+    def _spawn(self, ffmpeg_cmd, format_spec, cached, clip):
+        """Starts the downloader (unless the source is cached) and the encoder; returns both"""
+        if cached:
+            encoder = subprocess.Popen(ffmpeg_cmd, stderr=subprocess.PIPE, universal_newlines=True, bufsize=1)
+            lower_priority(encoder, self.niceness)
+            self.processes.append(encoder)
+            return None, encoder
+
+        ydl_cmd = ["yt-dlp", "--quiet", "-f", format_spec, "-o", "-", self.video_url]
+        if clip:
+            ydl_cmd[-1:-1] = ["--download-sections", f"*{self.clip_start}-{self.clip_end or 'inf'}"]
+        downloader = subprocess.Popen(ydl_cmd, stdout=subprocess.PIPE)
+        self.processes.append(downloader)
+        if SourceCache().enabled() and not clip:
+            # Feed ffmpeg through a tee so the source is kept for later conversions
+            encoder = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, bufsize=1)
+            self._teeing = True
+            threading.Thread(target=self._tee_source, args=(downloader, encoder, format_spec), daemon=True).start()
+        else:
+            encoder = subprocess.Popen(ffmpeg_cmd, stdin=downloader.stdout, stderr=subprocess.PIPE, universal_newlines=True, bufsize=1)
+            downloader.stdout.close()  # Let yt-dlp handle SIGPIPE if ffmpeg exits
+        lower_priority(encoder, self.niceness)
+        self.processes.append(encoder)
+        return downloader, encoder
+
+    def _restart_encoder(self, encoder, ffmpeg_cmd):
+        """
+        Replaces the encoder fed by the source tee, which replays what was downloaded so far to the new one,
+        so the download goes on. Without a running tee everything is stopped and None is returned.
+        """
+        with self._tee_lock:
+            if not self._teeing:
+                self._stop_processes()
+                return None
+            replacement = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, bufsize=1)
+            lower_priority(replacement, self.niceness)
+            self._next_encoder = replacement
+        encoder.terminate()
+        encoder.wait()
+        self.processes.remove(encoder)
+        self.processes.append(replacement)
+        return replacement
+
+    def _start_preview(self, selected, input_path, output_path, planned_kbps):
+        """Encodes the first seconds with the cheapest settings into preview.<ext>; it's published as soon as it's done"""
+        length = Config().get("preview_length", 45)
+        if input_path != "pipe:0":
+            inputs = [input_options(input_path, (self.clip_start, length))]
+        else:
+            # The download pipe belongs to the main encode, so the preview reads media URLs directly
+            inputs = []
+            for fmt in selected:
+                if not fmt.get("url"):
+                    return
+                headers = "".join(f"{key}: {value}\r\n" for key, value in (fmt.get("http_headers") or {}).items())
+                inputs.append((["-headers", headers] if headers else []) + input_options(fmt["url"], (self.clip_start, length)))
+
+        width, height, fps, extra_args = degrade_for_streaming(self.width, self.height, self.fps, 4, ProfileStore().video(self.dtype).supports_preset())
+        _, video_bitrate, _ = self._video_profile()
+        preview_kbps = (planned_kbps or format_selector.parse_bitrate(video_bitrate)) / 3
+        ffmpeg_cmd, file_ext = generate_ffmpeg_cmd_video(output_path, self.sm, self.dtype, width, height, fps, False, True, planned_kbps=preview_kbps)
+        override_args(ffmpeg_cmd, extra_args)
+        input_at = ffmpeg_cmd.index("-i")
+        ffmpeg_cmd[input_at:input_at + 2] = [arg for input_args in inputs for arg in input_args] + ["-map", "0:v:0", "-map", f"{len(inputs) - 1}:a:0?"]
+        ffmpeg_cmd[-1] = os.path.join(output_path, f"preview.{file_ext}")
+
+        proc = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        lower_priority(proc, self.niceness)
+        self.processes.append(proc)
+        self._preview_proc = proc
+        self._preview_thread = threading.Thread(target=self._publish_preview, args=(proc, file_ext), daemon=True)
+        self._preview_thread.start()
+
+    def _publish_preview(self, proc, file_ext):
+        started = time.time()
+        proc.wait()
+        if proc.returncode != 0 or self.cancelled or self.res is not None:
+            return
+        Staging().publish(self.identifier, f"preview.{file_ext}", os.path.join("cache", "content", self.identifier))
+        Tracer().record("preview", started, time.time(), self.identifier)
+        self.preview = file_ext
+        self.msg.append("Msg: Preview is ready\n")
+        self.new_msg = True
+
+    def _stop_preview(self):
+        """The full result makes the preview useless; it must not be published after the staging area is released"""
+        if self._preview_thread is None:
+            return
+        if self._preview_proc.poll() is None:
+            self._preview_proc.terminate()
+        self._preview_thread.join()
+
+    def _stop_processes(self):
+        for proc in self.processes:
+            proc.terminate()
+        for proc in self.processes:
+            proc.wait()
+        self.processes.clear()
+
+    def _expected_size(self, selected):
+        """Rough output size in bytes, for picking a staging area"""
+        if self.audio_only or all(f.get("vcodec") in (None, "none") for f in selected):
+            t, _ = audio_profile_index(self.dtype, self.audio_profile)
+            kbps = format_selector.parse_bitrate(get_ffmpeg_arg(ProfileStore().audio(t).args, "-b:a") or 0) or 320
+        elif (self.dtype == 1 or self.dtype > 4) and self.sm > 2:
+            kbps = sum(f.get("tbr") or 0 for f in selected) or 2000
+        else:
+            _, video_bitrate, audio_bitrate = self._video_profile()
+            kbps = format_selector.parse_bitrate(video_bitrate) + format_selector.parse_bitrate(audio_bitrate)
+        # Encoders overshoot the target bitrate, especially on short videos
+        return int(kbps * 1000 / 8 * max(self.duration, 1) * 1.5)
+
+    def _video_profile(self):
+        """Returns conversion args, video and audio bitrate of this task's video profile"""
+        profile = ProfileStore().video(self.dtype)
+        conv_args, video_bitrate, audio_bitrate = profile.args, profile.video_bitrate, profile.audio_bitrate
+        if video_bitrate == "0k":
+            video_bitrate = approximate_bitrate(self.width, self.height, self.fps)
+        return conv_args, video_bitrate, audio_bitrate
+
+    def _choose_formats(self, info):
+        """
+        Format spec to download and the format dicts it resolves to.
+        If nothing fits the target, the spec is pinned to what the fallback filter picks, so the dicts describe the download.
+        """
+        with Tracer().span("select formats"):
+            if self.audio_only:
+                format_spec, selected = self._select_audio_formats(info)
+            else:
+                format_spec, selected = self._select_formats(info)
+        if format_spec is not None:
+            format_selector.log_selection(self.video_url, info, selected, format_selector.default_formats(info, self.width, self.height))
+            return format_spec, selected
+
+        selected = [] if self.audio_only else format_selector.default_formats(info, self.width, self.height)
+        if not selected:
+            # yt-dlp's own choice; requested_formats (or the info itself for single-format sources) describes it
+            selected = info.get("requested_formats") or [info]
+        if not all(f.get("format_id") for f in selected):
+            return ("bestaudio/best" if self.audio_only else "best"), selected
+        return "+".join(f["format_id"] for f in selected), selected
+
+    def _select_formats(self, info):
+        """Cheapest formats that still satisfy this task's target profile"""
+        conv_args, video_bitrate, audio_bitrate = self._video_profile()
+        copy_video = (self.dtype == 1 or self.dtype > 4) and self.sm > 2
+        audio_codec = "mp4a" if copy_video or "aac" in conv_args else None
+
+        return format_selector.select_formats(
+            info, self.width, self.height, self.fps,
+            0 if copy_video else format_selector.parse_bitrate(video_bitrate),
+            format_selector.parse_bitrate(audio_bitrate),
+            copy_video, audio_codec
+        )
+
+    def _plan_bitrate(self, video_format, input_path):
+        """Video bitrate in kbps for the requested sizing mode, or None to use the profile one"""
+        if self.sizing_mode == bitrate_planner.SIZING_PROFILE or ((self.dtype == 1 or self.dtype > 4) and self.sm > 2):
+            return None
+        _, video_bitrate, audio_bitrate = self._video_profile()
+        profile_kbps = format_selector.parse_bitrate(video_bitrate)
+
+        if self.sizing_mode == bitrate_planner.SIZING_MAX_SIZE:
+            planned = min(profile_kbps, bitrate_planner.bitrate_for_size(self.max_mb, self.duration, format_selector.parse_bitrate(audio_bitrate)))
+        elif input_path != "pipe:0":
+            planned = bitrate_planner.bitrate_for_quality(profile_kbps, ["-i", input_path], self.duration, self.clip_start)
+        elif video_format.get("url"):
+            headers = "".join(f"{key}: {value}\r\n" for key, value in (video_format.get("http_headers") or {}).items())
+            input_args = (["-headers", headers] if headers else []) + ["-i", video_format["url"]]
+            planned = bitrate_planner.bitrate_for_quality(profile_kbps, input_args, self.duration, self.clip_start)
+        else:
+            return None
+
+        logging.info(f"Planned video bitrate for {self.video_url}: {planned:.0f}k (profile: {profile_kbps:.0f}k)")
+        return planned
+
+    def _select_audio_formats(self, info):
+        """Cheapest audio format for the target audio profile, preferring ones that can be passed through"""
+        t, _ = audio_profile_index(self.dtype, self.audio_profile)
+        conv_args = ProfileStore().audio(t).args
+        return format_selector.select_audio_formats(
+            info,
+            format_selector.parse_bitrate(get_ffmpeg_arg(conv_args, "-b:a") or 0),
+            AUDIO_CODEC_NAMES.get(get_ffmpeg_arg(conv_args, "-c:a"))
+        )
+
+    def _tee_source(self, downloader, encoder, format_spec):
+        part_path = SourceCache().new_part()
+        feeding = True
+        try:
+            with open(part_path, "wb") as part:
+                while chunk := downloader.stdout.read(65536):
+                    part.write(chunk)
+                    with self._tee_lock:
+                        replacement, self._next_encoder = self._next_encoder, None
+                    if replacement is not None:
+                        # The replay includes this chunk
+                        encoder, feeding = replacement, self._replay(part, part_path, encoder, replacement)
+                        continue
+                    if feeding:
+                        try:
+                            encoder.stdin.buffer.write(chunk)  # stdin is in text mode like stderr
+                        except (BrokenPipeError, ValueError):
+                            # ffmpeg is gone; stop if it was cancelled, otherwise finish the download for the cache
+                            feeding = False
+                            if self.cancelled:
+                                break
+                with self._tee_lock:
+                    self._teeing = False
+                    replacement, self._next_encoder = self._next_encoder, None
+                if replacement is not None:
+                    encoder, feeding = replacement, self._replay(part, part_path, encoder, replacement)
+            if feeding:
+                encoder.stdin.close()
+            downloader.wait()
+            if downloader.returncode == 0 and not self.cancelled:
+                SourceCache().commit(self.video_url, format_spec, part_path, self._info)
+                return
+        except OSError as e:
+            logging.error(f"Failed to cache source of {self.video_url}: {e}")
+            with self._tee_lock:
+                self._teeing = False
+                replacement, self._next_encoder = self._next_encoder, None
+            for proc in (encoder, replacement):
+                try:
+                    proc.stdin.close()
+                except (AttributeError, BrokenPipeError, OSError):
+                    pass
+        SourceCache().discard(part_path)
+
+    @staticmethod
+    def _replay(part, part_path, encoder, replacement):
+        """Writes the downloaded part of the source to a restarted encoder; False if it's already gone"""
+        try:
+            encoder.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        part.flush()
+        try:
+            with open(part_path, "rb") as downloaded:
+                while data := downloaded.read(65536):
+                    replacement.stdin.buffer.write(data)
+        except (BrokenPipeError, ValueError):
+            return False
+        return True
 
     def cancel(self):
+        self.cancelled = True
         for proc in self.processes:
             proc.terminate()
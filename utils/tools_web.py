@@ -1,8 +1,18 @@
 import os
 import re
+import gzip
+import zlib
 import uuid
+import hashlib
+import threading
+from collections import OrderedDict
 
 from utils.config import Config
+from utils import wbxml
+
+# Encoded page bodies by (sha1 of body, encoding). Static templates keep hitting this
+_encoded_cache = OrderedDict()
+_encoded_cache_lock = threading.Lock()
 
 def generate_links(host, path):
     http_link = f"http://{host}:5001/{path}"
@@ -54,13 +64,20 @@ def progress_bar_gen(progress_str):
     p_dec = p_int // 10
     return '[' + '#'*p_dec + '_'*(10-p_dec) + ']'
 
-def render_template(filename, replacements):
-    with open(os.path.join("web", filename)) as wap_file:
-        template = wap_file.read()
+def fill_template(template, replacements):
     for key, value in replacements.items():
         template = template.replace(key, str(value))
     return template
 
+def render_template(filename, replacements):
+    with open(os.path.join("web", filename)) as wap_file:
+        return fill_template(wap_file.read(), replacements)
+
+def render_template_parts(filename, replacements, separator):
+    """Splits the template at separator before filling it, so replacements can't contain the separator"""
+    with open(os.path.join("web", filename)) as wap_file:
+        return [fill_template(part, replacements) for part in wap_file.read().split(separator, 1)]
+
 def is_url(query):
     pattern = re.compile("^https?://\\S*\\.\\S+$")
     match = re.search(pattern, query)
@@ -83,6 +100,12 @@ def render_error_settings_wml(template, request, swap_dict=None):
     swap_dict["~8"] = request.args.get('sm') or "1"
     swap_dict["~9"] = request.args.get('fp') or "1"
     swap_dict["~q"] = request.args.get('mono') or "1"
+    swap_dict["~a"] = request.args.get('ao') or "0"
+    swap_dict["~b"] = request.args.get('abr') or "0"
+    swap_dict["~c"] = request.args.get('szm') or "0"
+    swap_dict["~d"] = request.args.get('mb') or "5"
+    swap_dict["~e"] = request.args.get('ss') or ""
+    swap_dict["~f"] = request.args.get('to') or ""
     res = render_template(template, swap_dict)
     return res
 
@@ -119,9 +142,22 @@ def render_settings_html_template(template, request):
     selected_rtsp = int(request.cookies.get("fp")) if request.cookies.get("fp") else 0
     swap_dict["~9"] = generate_html_select("fp", ["Off", "On", "Video only"], selected_rtsp)
 
+    selected_szm = int(request.cookies.get("szm")) if request.cookies.get("szm") else 0
+    swap_dict["~c"] = generate_html_select("szm", ["Device default", "Auto (by content)", "Limit to"], selected_szm)
+    swap_dict["~d"] = request.cookies.get("mb") or "5"
+    # Clip range belongs to one video, so it's never saved as a cookie
+    swap_dict["~e"] = request.args.get("ss") or ""
+    swap_dict["~f"] = request.args.get("to") or ""
+
     temp = "checked" if request.cookies.get("mono") == "1" else ""
     swap_dict["~@"] = f'<input type="checkbox" name="mono" value="1" {temp}> Always mono audio'
 
+    temp = "checked" if request.cookies.get("ao") == "1" else ""
+    swap_dict["~a"] = f'<input type="checkbox" name="ao" value="1" {temp}> Audio only (listen mode)'
+
+    temp = "checked" if request.cookies.get("abr") == "1" else ""
+    swap_dict["~b"] = f'<input type="checkbox" name="abr" value="1" {temp}> Fit quality to my connection speed'
+
     if request.args.get("error"):
         swap_dict["~0"] = "<b>Invalid input. Text fields only accept integers above 0</b>"
     else:
@@ -137,4 +173,60 @@ def generate_html_select(name, options, selected):
         else:
             markup = markup + f"<option value={i} selected>{options[i]}</option>\n"
     markup = markup + "</select>"
-    return markup
\ No newline at end of file
+    return markup
+
+def accepts_wmlc(request):
+    return "application/vnd.wap.wmlc" in request.headers.get("Accept", "")
+
+def pick_content_encoding(request):
+    accepted = request.headers.get("Accept-Encoding", "").lower()
+    if "gzip" in accepted:
+        return "gzip"
+    if "deflate" in accepted:
+        return "deflate"
+    return None
+
+def encode_body(body, encoding):
+    """Compiles WML to WBXML ("wmlc") or compresses a page ("gzip", "deflate"), caching the result"""
+    key = (hashlib.sha1(body).hexdigest(), encoding)
+    with _encoded_cache_lock:
+        if key in _encoded_cache:
+            _encoded_cache.move_to_end(key)
+            return _encoded_cache[key]
+
+    if encoding == "wmlc":
+        encoded = wbxml.encode_wml(body)
+    elif encoding == "gzip":
+        encoded = gzip.compress(body, compresslevel=6)
+    else:
+        encoded = zlib.compress(body, 6)
+
+    with _encoded_cache_lock:
+        _encoded_cache[key] = encoded
+        while len(_encoded_cache) > Config().get("encoded_page_cache_size", 64):
+            _encoded_cache.popitem(last=False)
+    return encoded
+
+def negotiate_wml(request, response):
+    """Sends compiled WBXML to WAP gateways that accept it"""
+    if response.mimetype != "text/vnd.wap.wml" or not accepts_wmlc(request):
+        return response
+    response.direct_passthrough = False
+    encoded = encode_body(response.get_data(), "wmlc")
+    if encoded is not None:
+        response.set_data(encoded)
+        response.mimetype = "application/vnd.wap.wmlc"
+    return response
+
+def negotiate_compression(request, response):
+    """Compresses text pages for clients that advertise gzip or deflate support"""
+    encoding = pick_content_encoding(request)
+    # Generated streams are sent as they come; files from send_file are small templates and can be read whole
+    if encoding is None or response.status_code != 200 or not response.mimetype.startswith("text/") \
+            or (response.is_streamed and not response.direct_passthrough) or "Content-Encoding" in response.headers:
+        return response
+    response.direct_passthrough = False
+    response.set_data(encode_body(response.get_data(), encoding))
+    response.headers["Content-Encoding"] = encoding
+    response.headers.add("Vary", "Accept-Encoding")
+    return response
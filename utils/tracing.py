@@ -0,0 +1,110 @@
+import sys
+import time
+import threading
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from utils.config import Config
+
+_sampling = threading.Lock()
+
+
+class Tracer:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._lock = threading.Lock()
+            cls._instance._traces = OrderedDict()  # identifier -> (started_at, spans)
+            cls._instance._local = threading.local()
+        return cls._instance
+
+    def enabled(self):
+        return bool(Config().get("tracing"))
+
+    @contextmanager
+    def bound(self, identifier):
+        """Spans recorded by this thread without an explicit identifier go to this one's timeline"""
+        previous = getattr(self._local, "identifier", None)
+        self._local.identifier = identifier
+        try:
+            yield
+        finally:
+            self._local.identifier = previous
+
+    @contextmanager
+    def span(self, name, identifier=None):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, started, time.time(), identifier)
+
+    def record(self, name, started, ended, identifier=None):
+        """Adds a span that ran from `started` to `ended` (time.time() values)"""
+        identifier = identifier or getattr(self._local, "identifier", None)
+        if not identifier or not self.enabled():
+            return
+        with self._lock:
+            if identifier not in self._traces:
+                self._traces[identifier] = (started, [])
+                while len(self._traces) > Config().get("trace_max_entries", 200):
+                    self._traces.popitem(last=False)
+            self._traces[identifier][1].append((name, started, ended, threading.current_thread().name))
+
+    def get(self, identifier):
+        """Timeline of an identifier as a JSON-serializable dict, or None"""
+        with self._lock:
+            entry = self._traces.get(identifier)
+            if entry is None:
+                return None
+            origin, spans = entry[0], sorted(entry[1], key=lambda span: span[1])
+        origin = min(origin, spans[0][1])
+        return {
+            "identifier": identifier,
+            "started_at": origin,
+            "spans": [
+                {
+                    "name": name,
+                    "start_ms": round((started - origin) * 1000, 1),
+                    "duration_ms": round((ended - started) * 1000, 1),
+                    "thread": thread
+                }
+                for name, started, ended, thread in spans
+            ]
+        }
+
+
+def sample_stacks(seconds, interval=0.01):
+    """
+    Samples stacks of all server threads for a while.
+    Returns collapsed stacks ("thread;outer;...;inner count" per line) that flamegraph.pl and speedscope can read
+    """
+    if not _sampling.acquire(blocking=False):
+        raise RuntimeError("Profiler is already running")
+    try:
+        return _collapse(_sample(seconds, interval))
+    finally:
+        _sampling.release()
+
+
+def _sample(seconds, interval):
+    counts = {}
+    own = threading.get_ident()
+    names = {}
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        names.update((thread.ident, thread.name) for thread in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = [f"{entry.name} ({entry.filename.rsplit('/', 1)[-1]}:{entry.lineno})" for entry in traceback.extract_stack(frame)]
+            stack = ";".join([names.get(ident, str(ident)), *frames])
+            counts[stack] = counts.get(stack, 0) + 1
+        time.sleep(interval)
+    return counts
+
+
+def _collapse(counts):
+    return "\n".join(f"{stack} {count}" for stack, count in sorted(counts.items())) + "\n"
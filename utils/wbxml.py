@@ -0,0 +1,204 @@
+import re
+import logging
+import xml.etree.ElementTree as ET
+
+# WBXML 1.1 global tokens
+SWITCH_PAGE = 0x00
+END = 0x01
+STR_I = 0x03
+LITERAL = 0x04
+EXT_I_0 = 0x40  # variable, escaped
+EXT_I_1 = 0x41  # variable, unescaped
+EXT_I_2 = 0x42  # variable, no conversion
+STR_T = 0x83
+
+WBXML_VERSION = 0x01
+WML_11_PUBLIC_ID = 0x04
+UTF8_MIB = 106
+
+# WML 1.1 tag tokens, code page 0
+TAGS = {
+    "a": 0x1C, "p": 0x20, "postfield": 0x21, "anchor": 0x22, "access": 0x23, "b": 0x24, "big": 0x25,
+    "br": 0x26, "card": 0x27, "do": 0x28, "em": 0x29, "fieldset": 0x2A, "go": 0x2B, "head": 0x2C,
+    "i": 0x2D, "img": 0x2E, "input": 0x2F, "meta": 0x30, "noop": 0x31, "prev": 0x32, "onevent": 0x33,
+    "optgroup": 0x34, "option": 0x35, "refresh": 0x36, "select": 0x37, "small": 0x38, "strong": 0x39,
+    "template": 0x3B, "timer": 0x3C, "u": 0x3D, "setvar": 0x3E, "wml": 0x3F,
+}
+
+# WML 1.1 attribute start tokens; (name, value prefix) -> token
+ATTR_STARTS = {
+    ("accept-charset", ""): 0x05, ("align", "bottom"): 0x06, ("align", "center"): 0x07,
+    ("align", "left"): 0x08, ("align", "middle"): 0x09, ("align", "right"): 0x0A, ("align", "top"): 0x0B,
+    ("alt", ""): 0x0C, ("content", ""): 0x0D, ("domain", ""): 0x0F, ("emptyok", "false"): 0x10,
+    ("emptyok", "true"): 0x11, ("format", ""): 0x12, ("height", ""): 0x13, ("hspace", ""): 0x14,
+    ("ivalue", ""): 0x15, ("iname", ""): 0x16, ("label", ""): 0x18, ("localsrc", ""): 0x19,
+    ("maxlength", ""): 0x1A, ("method", "get"): 0x1B, ("method", "post"): 0x1C, ("mode", "nowrap"): 0x1D,
+    ("mode", "wrap"): 0x1E, ("multiple", "false"): 0x1F, ("multiple", "true"): 0x20, ("name", ""): 0x21,
+    ("newcontext", "false"): 0x22, ("newcontext", "true"): 0x23, ("onpick", ""): 0x24,
+    ("onenterbackward", ""): 0x25, ("onenterforward", ""): 0x26, ("ontimer", ""): 0x27,
+    ("optional", "false"): 0x28, ("optional", "true"): 0x29, ("path", ""): 0x2A, ("scheme", ""): 0x2E,
+    ("sendreferer", "false"): 0x2F, ("sendreferer", "true"): 0x30, ("size", ""): 0x31, ("src", ""): 0x32,
+    ("ordered", "true"): 0x33, ("ordered", "false"): 0x34, ("tabindex", ""): 0x35, ("title", ""): 0x36,
+    ("type", ""): 0x37, ("type", "accept"): 0x38, ("type", "delete"): 0x39, ("type", "help"): 0x3A,
+    ("type", "password"): 0x3B, ("type", "onpick"): 0x3C, ("type", "onenterbackward"): 0x3D,
+    ("type", "onenterforward"): 0x3E, ("type", "ontimer"): 0x3F, ("type", "options"): 0x45,
+    ("type", "prev"): 0x46, ("type", "reset"): 0x47, ("type", "text"): 0x48, ("type", "vnd."): 0x49,
+    ("href", ""): 0x4A, ("href", "http://"): 0x4B, ("href", "https://"): 0x4C, ("value", ""): 0x4D,
+    ("vspace", ""): 0x4E, ("width", ""): 0x4F, ("xml:lang", ""): 0x50, ("align", ""): 0x52,
+    ("columns", ""): 0x53, ("class", ""): 0x54, ("id", ""): 0x55, ("forua", "false"): 0x56,
+    ("forua", "true"): 0x57, ("src", "http://"): 0x58, ("src", "https://"): 0x59, ("http-equiv", ""): 0x5A,
+    ("accesskey", ""): 0x5E, ("enctype", ""): 0x5F,
+}
+
+# WML 1.1 attribute value tokens, only used when they match the whole remaining value
+ATTR_VALUES = {
+    "accept": 0x89, "bottom": 0x8A, "clear": 0x8B, "delete": 0x8C, "help": 0x8D, "middle": 0x93,
+    "nowrap": 0x94, "onpick": 0x95, "onenterbackward": 0x96, "onenterforward": 0x97, "ontimer": 0x98,
+    "options": 0x99, "password": 0x9A, "reset": 0x9B, "text": 0x9D, "top": 0x9E, "unknown": 0x9F, "wrap": 0xA0,
+}
+
+# Elements with mixed content, where whitespace between words and tags matters
+INLINE_PARENTS = {"p", "a", "anchor", "b", "big", "em", "i", "small", "strong", "u", "option", "fieldset"}
+
+variable_re = re.compile(r"\$\(([A-Za-z_][\w]*)(?::(e|escape|u|unesc|n|noesc))?\)|\$([A-Za-z_][\w]*)")
+whitespace_re = re.compile(r"\s+")
+
+
+def mb_u_int32(value):
+    """Multi-byte integer encoding used throughout WBXML"""
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(out))
+
+
+class _Encoder:
+    def __init__(self, root):
+        self.root = root
+        self.table = bytearray()
+        self.offsets = {}
+        self._collect_strings(root)
+
+    def _collect_strings(self, root):
+        """Puts strings used more than once, and names without a token, into the string table"""
+        counts = {}
+        for element in root.iter():
+            if element.tag not in TAGS:
+                counts[element.tag] = 2
+            for name, value in element.attrib.items():
+                if self._start_token(name, value) is None:
+                    counts[name] = 2
+                for part in self._split_variables(value):
+                    if isinstance(part, str) and len(part) >= 4:
+                        counts[part] = counts.get(part, 0) + 1
+            for text in (element.text, element.tail):
+                for part in self._split_variables(self._clean(text)):
+                    if isinstance(part, str) and len(part) >= 4:
+                        counts[part] = counts.get(part, 0) + 1
+        for string, count in counts.items():
+            if count > 1:
+                self.offsets[string] = len(self.table)
+                self.table += string.encode("utf-8") + b"\x00"
+
+    @staticmethod
+    def _clean(text, inline=False):
+        """Collapses whitespace like a WML browser would; formatting-only whitespace is dropped"""
+        if not text or (not inline and not text.strip()):
+            return ""
+        return whitespace_re.sub(" ", text)
+
+    @staticmethod
+    def _split_variables(text):
+        """Splits text into plain strings and (variable_name, token) tuples"""
+        parts = []
+        pos = 0
+        for match in variable_re.finditer(text or ""):
+            if match.start() > pos:
+                parts.append(text[pos:match.start()])
+            conversion = match.group(2) or ""
+            token = EXT_I_0 if conversion.startswith("e") else EXT_I_1 if conversion.startswith("u") else EXT_I_2
+            parts.append((match.group(1) or match.group(3), token))
+            pos = match.end()
+        if pos < len(text or ""):
+            parts.append(text[pos:])
+        return parts
+
+    def _string(self, out, text):
+        for part in self._split_variables(text):
+            if isinstance(part, tuple):
+                out.append(part[1])
+                out += part[0].encode("utf-8") + b"\x00"
+            elif part in self.offsets:
+                out.append(STR_T)
+                out += mb_u_int32(self.offsets[part])
+            else:
+                out.append(STR_I)
+                out += part.encode("utf-8") + b"\x00"
+
+    @staticmethod
+    def _start_token(name, value):
+        """Longest matching (name, value prefix) start token as (prefix, token), or None"""
+        best = None
+        for (attr, prefix), token in ATTR_STARTS.items():
+            if attr == name and value.startswith(prefix) and (best is None or len(prefix) > len(best[0])):
+                best = (prefix, token)
+        return best
+
+    def _attribute(self, out, name, value):
+        best = self._start_token(name, value)
+        if best is None:
+            out.append(LITERAL)
+            out += mb_u_int32(self.offsets[name])
+            rest = value
+        else:
+            out.append(best[1])
+            rest = value[len(best[0]):]
+        if rest in ATTR_VALUES:
+            out.append(ATTR_VALUES[rest])
+        elif rest:
+            self._string(out, rest)
+
+    def _element(self, out, element):
+        inline = element.tag in INLINE_PARENTS
+        has_attrs = bool(element.attrib)
+        has_content = bool(len(element)) or bool(self._clean(element.text, inline))
+        flags = (0x80 if has_attrs else 0) | (0x40 if has_content else 0)
+        if element.tag in TAGS:
+            out.append(TAGS[element.tag] | flags)
+        else:
+            out.append(LITERAL | flags)
+            out += mb_u_int32(self.offsets[element.tag])
+
+        if has_attrs:
+            for name, value in element.attrib.items():
+                self._attribute(out, name, value)
+            out.append(END)
+
+        if has_content:
+            text = self._clean(element.text, inline)
+            if text:
+                self._string(out, text)
+            for child in element:
+                self._element(out, child)
+                tail = self._clean(child.tail, inline)
+                if tail:
+                    self._string(out, tail)
+            out.append(END)
+
+    def encode(self):
+        body = bytearray()
+        self._element(body, self.root)
+        header = bytes([WBXML_VERSION, WML_11_PUBLIC_ID]) + mb_u_int32(UTF8_MIB) + mb_u_int32(len(self.table))
+        return header + bytes(self.table) + bytes(body)
+
+
+def encode_wml(markup):
+    """Compiles WML markup to WBXML. Returns None if markup isn't well-formed XML"""
+    try:
+        root = ET.fromstring(markup.encode("utf-8") if isinstance(markup, str) else markup)
+    except ET.ParseError as e:
+        logging.warning(f"Sending plain WML, couldn't compile it: {e}")
+        return None
+    return _Encoder(root).encode()
@@ -0,0 +1,91 @@
+import threading
+import argparse
+import logging
+import socket
+import time
+import os
+from server import create_server
+from utils.cleaner import Cleaner
+from utils.config import Config
+from utils.job_queue import JobQueue
+from utils.profiles import ProfileStore
+from utils.tools_conv import VideoProcessor
+
+
+def run_flask_server():
+    create_server().run(host='0.0.0.0', port=Config().get("worker_port", 5002))
+
+
+def publish(identifier, task):
+    """Mirrors progress of a local VideoProcessor into the job queue until it finishes"""
+    while task.res is None:
+        if JobQueue().is_cancelled(identifier):
+            task.cancel()
+            logging.info(f"Job {identifier} was cancelled")
+        JobQueue().update(identifier, progress=task.progress, msgs=task.msg)
+        time.sleep(1)
+
+    JobQueue().update(identifier, progress=task.progress, msgs=task.msg, res=task.res, status="done")
+    if task.res != "err":
+        Cleaner().add_content(
+            os.path.join("cache", "content", identifier),
+            time.time() + task.duration * Config().get("video_lifetime_multiplier")
+        )
+    elif task.cancelled:
+        Cleaner().remove_content_at(os.path.join("cache", "content", identifier))
+
+
+def work(name):
+    playback_url = Config().get("worker_playback_url") or None
+    while True:
+        job = JobQueue().claim(name, playback_url)
+        if job is None:
+            time.sleep(Config().get("worker_poll_interval", 2))
+            continue
+
+        identifier, params = job
+        try:
+            task = VideoProcessor(identifier=identifier, **params)
+            Config().add_conv_task(identifier, task)
+            task.start_conversion()
+            publish(identifier, task)
+        except Exception as e:
+            logging.error(f"Worker {name} failed on job {identifier}: {e}")
+            JobQueue().update(identifier, res="err", status="done")
+        finally:
+            Config().conv_tasks.pop(identifier, None)
+
+
+def requeue_stale():
+    while True:
+        JobQueue().requeue_stale(Config().get("worker_stale_timeout", 120))
+        time.sleep(Config().get("worker_stale_timeout", 120))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OurTube conversion worker")
+    parser.add_argument("--name", default=socket.gethostname(), help="Worker name shown in the job queue")
+    parser.add_argument("--jobs", type=int, default=1, help="How many conversions to run at once")
+    args = parser.parse_args()
+
+    try:
+        Config().is_worker = True
+        logging.basicConfig(level=Config().get("log_level", 40))
+        ProfileStore()
+        os.makedirs(os.path.join("cache", "content"), exist_ok=True)
+
+        threading.Thread(target=Cleaner().run, daemon=True).start()
+        threading.Thread(target=requeue_stale, daemon=True).start()
+
+        # Serve produced files so the front-end can redirect /api/playback here
+        if Config().get("worker_playback_url"):
+            threading.Thread(target=run_flask_server, daemon=True).start()
+
+        threads = [threading.Thread(target=work, args=(f"{args.name}-{n}",)) for n in range(args.jobs)]
+        for thread in threads:
+            thread.start()
+        logging.info(f"Worker {args.name} started with {args.jobs} slot(s)")
+        for thread in threads:
+            thread.join()
+    except Exception as e:
+        logging.critical(f"Unhandled error in worker: {e}")